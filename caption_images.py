@@ -1,39 +1,193 @@
+# Import the built-in libraries
+import os
+import sys
+import time
+
 # Import the external libraries
 from PIL import Image
 from transformers import AutoProcessor, AutoModelForCausalLM
+from rich.console import Console
+from rich.table import Table
 import torch
 
+# Import the local files
+from memory_budget import open_image
+
 # MODEL URL: https://huggingface.co/microsoft/git-base-textcaps
+GIT_MODEL = "microsoft/git-base-textcaps"
+
+# Use the int8 quantized model on the CPU, off by default because it changes the captions a little
+# Turn it on with use_cpu_optimized (ofts_cli.py --cpu-optimized)
+CPU_OPTIMIZED = False
 
-def tag_image_GIT(image_path: str):
+# Loaded processor and models, keyed by whether the model is quantized
+# Loading GIT takes seconds, so we only want to do it once per process
+_GIT_CACHE = {}
+
+# console object
+console = Console()
+
+def use_cpu_optimized(enabled: bool = True):
+    """
+        Turn the CPU inference mode (int8 quantized GIT) on or off
+        Args:
+            enabled (bool): use the quantized model
+        Returns:
+            None
+    """
+    global CPU_OPTIMIZED
+    CPU_OPTIMIZED = enabled
+
+def configure_cpu_threads(num_workers: int = 1):
+    """
+        Split the CPU cores between the pipeline workers and torch
+        Args:
+            num_workers (int): the number of pipeline workers running inference at the same time
+        Returns:
+            int: the number of intra-op threads given to torch
+    """
+    # Every worker gets an equal share of the cores, so N workers don't oversubscribe the CPU
+    cpu_count = os.cpu_count() or 1
+    intra_op_threads = max(1, cpu_count // max(1, num_workers))
+    torch.set_num_threads(intra_op_threads)
+
+    # inter-op threads can only be set before torch runs any parallel work
+    try:
+        torch.set_num_interop_threads(1 if num_workers > 1 else min(2, cpu_count))
+    except RuntimeError:
+        pass
+    return intra_op_threads
+
+def load_GIT(quantized: bool = False):
+    """
+        Load the GIT processor and model once and cache them
+        Args:
+            quantized (bool): apply int8 dynamic quantization to the linear layers (CPU only)
+        Returns:
+            tuple: the processor, the model and the device
+    """
+    if quantized in _GIT_CACHE:
+        return _GIT_CACHE[quantized]
+
+    print("Downloading GIT-BASE-TEXTCAPS...")
+    processor = AutoProcessor.from_pretrained(GIT_MODEL)
+    model = AutoModelForCausalLM.from_pretrained(GIT_MODEL)
+    model.eval()
+
+    # Dynamic quantization only runs on the CPU
+    if quantized:
+        device = "cpu"
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model.to(device)
+
+    _GIT_CACHE[quantized] = (processor, model, device)
+    return _GIT_CACHE[quantized]
+
+def tag_image_GIT(
+        image_path: str,
+        cpu_optimized: bool = None,
+        max_length: int = 20
+    ):
     """
         This function takes an image path as input and returns a caption for the image
         using the GIT model from Microsoft.
 
         Args:
             image_path (str): The path to the image file.
+            cpu_optimized (bool): Use the int8 quantized model. Defaults to CPU_OPTIMIZED.
+            max_length (int): The maximum number of tokens to generate.
 
         Returns:
             str: A caption for the image.
     """
     # Look here for complete documentation: https://github.com/NielsRogge/Transformers-Tutorials/tree/master/GIT
-    # Load the image
-    image = Image.open(image_path).convert('RGB')
+    # Load the image, oversized images are downscaled while they are decoded
+    image = open_image(image_path)
+    return tag_images_GIT([image], cpu_optimized=cpu_optimized, max_length=max_length)[0]
 
-    # Load the processor and model
-    print("Downloading GIT-BASE-TEXTCAPS...")
-    processor = AutoProcessor.from_pretrained("microsoft/git-base-textcaps")
-    model = AutoModelForCausalLM.from_pretrained("microsoft/git-base-textcaps")
+def tag_images_GIT(
+        images: list,
+        cpu_optimized: bool = None,
+        max_length: int = 20
+    ):
+    """
+        Caption a batch of PIL images with a single forward pass
+        Args:
+            images (list): a list of RGB PIL images
+            cpu_optimized (bool): use the int8 quantized model. Defaults to CPU_OPTIMIZED.
+            max_length (int): the maximum number of tokens to generate
+        Returns:
+            list: a caption for every image
+    """
+    if cpu_optimized is None:
+        cpu_optimized = CPU_OPTIMIZED
+    processor, model, device = load_GIT(quantized=cpu_optimized)
+
+    # Preprocess the images and convert them to a pytorch tensor
+    pixel_values = processor(images=images, return_tensors="pt").pixel_values.to(device)
+
+    # Greedy decoding with the KV cache, no autograd bookkeeping
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            pixel_values=pixel_values,
+            max_length=max_length,
+            num_beams=1,
+            do_sample=False,
+            use_cache=True,
+        )
+    return processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+def compare_quantized_captions(image_paths: list):
+    """
+        Compare the fp32 and the int8 quantized captions on a sample of images
+        Args:
+            image_paths (list): the sample images
+        Returns:
+            dict: the average latency of both models and the average word overlap
+    """
+    rtable = Table(title="FP32 vs INT8 captions")
+    rtable.add_column("Image", style="bold")
+    rtable.add_column("FP32", style="")
+    rtable.add_column("INT8", style="")
+    rtable.add_column("Overlap", style="bold")
+
+    # Load both models up front so the loading time doesn't count as inference
+    load_GIT(quantized=False)
+    load_GIT(quantized=True)
+
+    fp32_time, int8_time, overlap_total = 0.0, 0.0, 0.0
+    for image_path in image_paths:
+        image = Image.open(image_path).convert('RGB')
+
+        start = time.perf_counter()
+        fp32_caption = tag_images_GIT([image], cpu_optimized=False)[0]
+        fp32_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        int8_caption = tag_images_GIT([image], cpu_optimized=True)[0]
+        int8_time += time.perf_counter() - start
 
-    # Preprocess the image and convert it to pytorch tensor
-    pixel_values = processor(images=image, return_tensors="pt").pixel_values
+        # Jaccard overlap of the caption words
+        fp32_words, int8_words = set(fp32_caption.split()), set(int8_caption.split())
+        overlap = len(fp32_words & int8_words) / max(1, len(fp32_words | int8_words))
+        overlap_total += overlap
+        rtable.add_row(os.path.basename(image_path), fp32_caption, int8_caption, f"{overlap:.2f}")
 
-    # move the model and tensor to the device
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.to(device)
-    pixel_values = pixel_values.to(device)
+    count = max(1, len(image_paths))
+    report = {
+        "fp32_seconds_per_image": fp32_time / count,
+        "int8_seconds_per_image": int8_time / count,
+        "speedup": fp32_time / int8_time if int8_time else 0.0,
+        "average_overlap": overlap_total / count,
+    }
+    console.print(rtable)
+    console.print(f"FP32: {report['fp32_seconds_per_image']:.3f}s/image  INT8: {report['int8_seconds_per_image']:.3f}s/image  "
+                  f"Speedup: {report['speedup']:.2f}x  Average overlap: {report['average_overlap']:.2f}", style="bold green")
+    return report
 
-    # Generate the caption and decode it using processor
-    generated_ids = model.generate(pixel_values=pixel_values, max_length=20)
-    caption = processor.batch_decode(generated_ids, skip_special_tokens=True)
-    return caption[0]
+# Accuracy/throughput report: python3 caption_images.py image1.jpg image2.jpg ...
+if __name__ == "__main__":
+    configure_cpu_threads()
+    compare_quantized_captions(sys.argv[1:])
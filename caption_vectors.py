@@ -0,0 +1,511 @@
+# Import the built-in libraries
+import os
+import re
+import zlib
+import fcntl
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# Import the external libraries
+import numpy as np
+from rich.console import Console
+
+# Import the local files
+import ofts_database as ofts_db
+
+# Caption embeddings are stored next to the database of every library:
+# - caption_vectors.f16, a raw float16 matrix with one row per caption (memory-mapped when searching)
+# - the caption_vectors table, which maps every row of the matrix to the rowid of the image
+# - caption_vector_ids.i64, a raw int64 copy of that mapping (-1 for rows without an image),
+#   memory-mapped by searches so they never read the whole table
+
+# Encoder used when a library doesn't have caption vectors yet
+DEFAULT_ENCODER = "minilm"
+
+# float16 halves the size of the matrix, cosine similarity doesn't need more precision
+VECTOR_DTYPE = np.float16
+
+# Rowid of the image of every row of the matrix
+ID_DTYPE = np.int64
+
+# Rows converted to float32 and scored at once, so searching never loads the whole matrix in memory
+SEARCH_CHUNK = 8192
+
+# Threads scoring the matrix, numpy releases the GIL while it converts and multiplies
+SEARCH_THREADS = 4
+
+# Captions less similar than this to the query are unrelated, they are left out of the hybrid search
+MIN_SIMILARITY = 0.2
+
+# Min-max normalization gives the weakest candidate of each list 0, fused scores at or below this are left out
+MIN_SCORE = 0.05
+
+# Loaded encoders, loading a transformer takes seconds
+_ENCODERS = {}
+
+# console object
+console = Console()
+
+class HashingEncoder:
+    """
+        Deterministic offline encoder: words and character trigrams are hashed into a fixed
+        number of dimensions. No model to download, for tests and machines without the network.
+    """
+    name = "hashing"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def encode(self, texts: list):
+        """
+            Args:
+                texts (list): the texts to encode
+            Returns:
+                np.ndarray: one L2 normalized float32 row per text
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                features = [word] + [word[j:j + 3] for j in range(max(1, len(word) - 2))]
+                for feature in features:
+                    h = zlib.crc32(feature.encode())
+                    vectors[i, h % self.dim] += 1.0 if (h >> 16) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-10)
+
+class TransformerEncoder:
+    """
+        Local sentence embedding model (mean pooled transformer), runs on the CPU
+        MODEL URL: https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2
+    """
+    name = "minilm"
+
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
+        from transformers import AutoTokenizer, AutoModel
+        import torch
+
+        print("Downloading ALL-MINILM-L6-V2...")
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts: list):
+        """
+            Args:
+                texts (list): the texts to encode
+            Returns:
+                np.ndarray: one L2 normalized float32 row per text
+        """
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=64, return_tensors="pt")
+        with self.torch.inference_mode():
+            hidden = self.model(**inputs).last_hidden_state
+
+        # Mean of the token embeddings, padding left out
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        vectors = ((hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).numpy()
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-10)).astype(np.float32)
+
+# Available encoders, anything with name, dim and encode(texts) can be added here
+ENCODERS = {
+    HashingEncoder.name: HashingEncoder,
+    TransformerEncoder.name: TransformerEncoder,
+}
+
+def get_encoder(name: str = DEFAULT_ENCODER):
+    """
+        Load an encoder once and cache it
+        Args:
+            name (str): the name of the encoder
+        Returns:
+            the encoder
+    """
+    if name not in _ENCODERS:
+        _ENCODERS[name] = ENCODERS[name]()
+    return _ENCODERS[name]
+
+def vectors_path(db_path: str):
+    """
+        The caption vector matrix of a library
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            str: the path to the matrix
+    """
+    return os.path.join(os.path.dirname(db_path), "caption_vectors.f16")
+
+def ids_path(db_path: str):
+    """
+        The row -> image mapping of the caption vector matrix of a library
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            str: the path to the mapping
+    """
+    return os.path.join(os.path.dirname(db_path), "caption_vector_ids.i64")
+
+def write_vector_ids(cursor: sqlite3.Cursor, db_path: str, rows: int):
+    """
+        Write the row -> image mapping file from the caption_vectors table, call it holding the matrix lock
+        Args:
+            cursor (sqlite3.Cursor): a cursor of an open connection
+            db_path (str): the path to the SQLite database file
+            rows (int): the number of rows of the matrix
+        Returns:
+            None
+    """
+    photo_ids = np.full(rows, -1, dtype=ID_DTYPE)
+    for row, photo_id in cursor.execute("SELECT row, photo_id FROM caption_vectors WHERE row < ?", (rows,)):
+        photo_ids[row] = photo_id
+
+    # Searches may be reading the old file
+    temporary_path = f"{ids_path(db_path)}.{os.getpid()}"
+    photo_ids.tofile(temporary_path)
+    os.replace(temporary_path, ids_path(db_path))
+
+def rebuild_vector_ids(db_path: str, force: bool = False):
+    """
+        Create the row -> image mapping file of a library whose vectors were made before it existed
+        Args:
+            db_path (str): the path to the SQLite database file
+            force (bool): write it again even if it exists
+        Returns:
+            None
+    """
+    with open(f"{vectors_path(db_path)}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        conn = ofts_db.connect(db_path)
+        try:
+            if force or not os.path.exists(ids_path(db_path)):
+                cursor = conn.cursor()
+                create_vector_tables(cursor)
+                rows = cursor.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM caption_vectors").fetchone()[0]
+                write_vector_ids(cursor, db_path, rows)
+        finally:
+            conn.close()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def create_vector_tables(cursor: sqlite3.Cursor):
+    """
+        Creates the row -> image mapping and the encoder the vectors were made with
+        Args:
+            cursor (sqlite3.Cursor): a cursor of an open connection
+        Returns:
+            None
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS caption_vectors (
+        row INTEGER PRIMARY KEY,
+        photo_id INTEGER NOT NULL UNIQUE
+    );
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS caption_vector_meta (
+        encoder TEXT NOT NULL,
+        dim INTEGER NOT NULL
+    );
+    ''')
+
+def stored_encoder(db_path: str):
+    """
+        The name of the encoder the vectors of a library were made with
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            str: the name of the encoder, None if the library has no vectors yet
+    """
+    conn = ofts_db.connect(db_path)
+    try:
+        create_vector_tables(conn.cursor())
+        row = conn.execute("SELECT encoder FROM caption_vector_meta").fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def encoder_for(db_path: str, name: str = None):
+    """
+        The encoder of a library, queries must be encoded with the same encoder as the captions
+        Args:
+            db_path (str): the path to the SQLite database file
+            name (str): the encoder to use if the library has no vectors yet
+        Returns:
+            the encoder
+    """
+    return get_encoder(stored_encoder(db_path) or name or DEFAULT_ENCODER)
+
+def add_caption_vectors(db_path: str, captions: list, encoder = None):
+    """
+        Encode captions and append them to the caption vector matrix
+        Images that already have a vector are skipped.
+        Args:
+            db_path (str): the path to the SQLite database file
+            captions (list): a list of (rowid of the image, caption) tuples
+            encoder: the encoder, the one of the library by default
+        Returns:
+            int: the number of vectors added
+    """
+    captions = list(dict((photo_id, caption) for photo_id, caption in captions if photo_id is not None).items())
+    if not captions:
+        return 0
+    encoder = encoder or encoder_for(db_path)
+    vectors = encoder.encode([caption for _, caption in captions]).astype(VECTOR_DTYPE)
+    path = vectors_path(db_path)
+    row_bytes = encoder.dim * np.dtype(VECTOR_DTYPE).itemsize
+
+    # Other ingestion processes may append to the same matrix
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        conn = ofts_db.connect(db_path)
+        try:
+            ofts_db.begin_write(conn)
+            cursor = conn.cursor()
+            create_vector_tables(cursor)
+            if not cursor.execute("SELECT 1 FROM caption_vector_meta").fetchone():
+                cursor.execute("INSERT INTO caption_vector_meta (encoder, dim) VALUES (?, ?)", (encoder.name, encoder.dim))
+
+            # Another process may have encoded some of the images since they were picked
+            placeholders = ", ".join("?" * len(captions))
+            encoded = {row[0] for row in cursor.execute(f'''
+            SELECT photo_id FROM caption_vectors WHERE photo_id IN ({placeholders})
+            ''', [photo_id for photo_id, _ in captions])}
+            keep = [i for i, (photo_id, _) in enumerate(captions) if photo_id not in encoded]
+            if not keep:
+                conn.rollback()
+                return 0
+
+            # Rows written by a process that died before committing are dropped
+            rows = cursor.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM caption_vectors").fetchone()[0]
+            if not os.path.exists(ids_path(db_path)) or os.path.getsize(ids_path(db_path)) < rows * np.dtype(ID_DTYPE).itemsize:
+                write_vector_ids(cursor, db_path, rows)
+            with open(ids_path(db_path), "ab") as f:
+                f.truncate(rows * np.dtype(ID_DTYPE).itemsize)
+                f.write(np.array([captions[k][0] for k in keep], dtype=ID_DTYPE).tobytes())
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+                f.write(vectors[keep].tobytes())
+            cursor.executemany('''
+            INSERT INTO caption_vectors (row, photo_id) VALUES (?, ?)
+            ''', [(rows + i, captions[k][0]) for i, k in enumerate(keep)])
+            conn.commit()
+        finally:
+            conn.close()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return len(keep)
+
+def backfill_caption_vectors(
+        db_path: str,
+        encoder_name: str = None,
+        batch_size: int = 256
+    ):
+    """
+        Encode the stored captions of images that don't have a vector yet, no re-captioning needed
+        It can be stopped and started again, only the missing captions are encoded.
+        Choosing another encoder than the one of the library drops the old vectors first.
+        Args:
+            db_path (str): the path to the SQLite database file
+            encoder_name (str): the encoder to use, the one of the library by default
+            batch_size (int): the number of captions encoded at once
+        Returns:
+            int: the number of vectors added
+    """
+    current = stored_encoder(db_path)
+    if encoder_name and current and encoder_name != current:
+        drop_caption_vectors(db_path)
+    elif not vectors_consistent(db_path):
+        # Left behind by older versions, which could write a vector at the wrong row
+        console.print("The caption vectors are inconsistent, encoding them again.", style="bold red")
+        drop_caption_vectors(db_path)
+    else:
+        # The mapping file may be missing or out of date, searches only read that file
+        rebuild_vector_ids(db_path, force=True)
+    encoder = encoder_for(db_path, encoder_name)
+
+    # Every batch starts after the last image of the previous one, instead of scanning the table from the start
+    added = 0
+    last_rowid = 0
+    while True:
+        conn = ofts_db.connect(db_path)
+        try:
+            captions = conn.execute('''
+            SELECT photos.rowid, photos.caption
+            FROM photos
+            LEFT JOIN caption_vectors ON caption_vectors.photo_id = photos.rowid
+            WHERE photos.rowid > ? AND caption_vectors.photo_id IS NULL
+            ORDER BY photos.rowid
+            LIMIT ?
+            ''', (last_rowid, batch_size)).fetchall()
+        finally:
+            conn.close()
+        if not captions:
+            return added
+        last_rowid = captions[-1][0]
+        added += add_caption_vectors(db_path, captions, encoder)
+        console.print(f"Encoded {added} captions...", style="")
+
+def vectors_consistent(db_path: str):
+    """
+        Check that every row of the matrix up to the last one belongs to exactly one image
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            bool: False if rows are missing from the table or from the file
+    """
+    conn = ofts_db.connect(db_path)
+    try:
+        create_vector_tables(conn.cursor())
+        meta = conn.execute("SELECT dim FROM caption_vector_meta").fetchone()
+        count, last = conn.execute("SELECT COUNT(*), MAX(row) FROM caption_vectors").fetchone()
+    finally:
+        conn.close()
+    if meta is None or count == 0:
+        return True
+    path = vectors_path(db_path)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return last + 1 == count and size >= count * meta[0] * np.dtype(VECTOR_DTYPE).itemsize
+
+def drop_caption_vectors(db_path: str):
+    """
+        Remove all the caption vectors of a library
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            None
+    """
+    conn = ofts_db.connect(db_path)
+    try:
+        conn.execute("DROP TABLE IF EXISTS caption_vectors")
+        conn.execute("DROP TABLE IF EXISTS caption_vector_meta")
+        conn.commit()
+    finally:
+        conn.close()
+    for path in (vectors_path(db_path), ids_path(db_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def load_caption_vectors(db_path: str):
+    """
+        Memory-map the caption vector matrix of a library
+        Args:
+            db_path (str): the path to the SQLite database file
+        Returns:
+            tuple: the matrix (None if there are no vectors) and the rowid of the image of every row,
+            -1 for rows without an image
+    """
+    conn = ofts_db.connect(db_path)
+    try:
+        create_vector_tables(conn.cursor())
+        meta = conn.execute("SELECT dim FROM caption_vector_meta").fetchone()
+    finally:
+        conn.close()
+
+    path = vectors_path(db_path)
+    if meta is None or not os.path.exists(path):
+        return None, np.empty(0, dtype=ID_DTYPE)
+    if not os.path.exists(ids_path(db_path)):
+        rebuild_vector_ids(db_path)
+
+    # Either file can be longer than the other while another process is appending
+    rows = min(
+        os.path.getsize(path) // (meta[0] * np.dtype(VECTOR_DTYPE).itemsize),
+        os.path.getsize(ids_path(db_path)) // np.dtype(ID_DTYPE).itemsize,
+    )
+    if rows == 0:
+        return None, np.empty(0, dtype=ID_DTYPE)
+    photo_ids = np.memmap(ids_path(db_path), dtype=ID_DTYPE, mode="r", shape=(rows,))
+    matrix = np.memmap(path, dtype=VECTOR_DTYPE, mode="r", shape=(rows, meta[0]))
+    return matrix, photo_ids
+
+def vector_search(db_path: str, query: str, top_k: int = 200):
+    """
+        Find the captions closest in meaning to the query
+        Args:
+            db_path (str): the path to the SQLite database file
+            query (str): the text to search
+            top_k (int): the number of images to return
+        Returns:
+            list: a list of (rowid of the image, cosine similarity) tuples, best first
+    """
+    matrix, photo_ids = load_caption_vectors(db_path)
+    if matrix is None or len(matrix) == 0:
+        return []
+    query_vector = encoder_for(db_path).encode([query])[0].astype(np.float32)
+
+    # Converting float16 to float32 is most of the work (numpy has no fast float16 matrix product),
+    # every thread converts its share of the rows chunk by chunk into one reused buffer
+    scores = np.empty(len(matrix), dtype=np.float32)
+
+    def score_rows(first: int, last: int):
+        chunk = np.empty((min(SEARCH_CHUNK, last - first), matrix.shape[1]), dtype=np.float32)
+        for start in range(first, last, SEARCH_CHUNK):
+            rows = min(SEARCH_CHUNK, last - start)
+            np.copyto(chunk[:rows], matrix[start:start + rows])
+            np.dot(chunk[:rows], query_vector, out=scores[start:start + rows])
+
+    threads = max(1, min(SEARCH_THREADS, os.cpu_count() or 1, len(matrix) // SEARCH_CHUNK))
+    bounds = np.linspace(0, len(matrix), threads + 1).astype(np.int64).tolist()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(score_rows, bounds[:-1], bounds[1:]))
+    scores[photo_ids < 0] = -np.inf
+
+    best = np.argpartition(-scores, min(top_k, len(scores)) - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+    return [(int(photo_ids[row]), float(scores[row])) for row in best if photo_ids[row] >= 0]
+
+def normalize_scores(scores: dict):
+    """
+        Min-max normalize scores to 0..1, so bm25 and cosine similarity can be added
+        Args:
+            scores (dict): a mapping of rowid -> score, higher is better
+        Returns:
+            dict: the normalized scores
+    """
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {photo_id: 1.0 for photo_id in scores}
+    return {photo_id: (score - low) / (high - low) for photo_id, score in scores.items()}
+
+def hybrid_search(
+        db_path: str,
+        query: str,
+        top_k: int = 50,
+        vector_weight: float = 0.5,
+        min_similarity: float = MIN_SIMILARITY,
+        min_score: float = MIN_SCORE
+    ):
+    """
+        Fuse the bm25 scores of the FTS index with the cosine similarity of the caption vectors
+        Args:
+            db_path (str): the path to the SQLite database file
+            query (str): the text to search
+            top_k (int): the number of images to return
+            vector_weight (float): 0 is FTS only, 1 is vectors only
+            min_similarity (float): captions with a lower cosine similarity are left out
+            min_score (float): images with a fused score at or below this are left out
+        Returns:
+            list: a list of (image_path, faces, caption, score) tuples, best first
+    """
+    # FTS5 ranks are negative bm25 scores, lower is better
+    fts_scores = normalize_scores({photo_id: -rank for photo_id, rank in ofts_db.search_image_ids(query, db_path, limit=top_k * 4)})
+
+    # The nearest captions are returned even when none of them is related to the query
+    vector_scores = normalize_scores({
+        photo_id: similarity
+        for photo_id, similarity in vector_search(db_path, query, top_k=top_k * 4)
+        if similarity >= min_similarity
+    })
+
+    fused = {
+        photo_id: vector_weight * vector_scores.get(photo_id, 0.0) + (1 - vector_weight) * fts_scores.get(photo_id, 0.0)
+        for photo_id in set(fts_scores) | set(vector_scores)
+    }
+    ranked = sorted(
+        [(photo_id, score) for photo_id, score in fused.items() if score > min_score],
+        key=lambda item: item[1],
+        reverse=True
+    )[:top_k]
+    images = ofts_db.get_images(db_path, [photo_id for photo_id, _ in ranked])
+    return [images[photo_id] + (score,) for photo_id, score in ranked if photo_id in images]
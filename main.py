@@ -2,6 +2,7 @@
 
 # Importing the inbuilt libraries
 import os
+import zlib
 from os import walk
 from pathlib import Path
 
@@ -11,9 +12,14 @@ from rich.progress import track
 from rich.console import Console
 
 # Importing the local files
-from recognize_faces import rec_face_image
-from caption_images import tag_image_GIT
+from recognize_faces import rec_face_image, list_identities, merge_identities
+from recognize_faces import embed_image, find_similar_identities, identity_embeddings, use_known_embedding_folder
+from caption_images import tag_images_GIT, configure_cpu_threads
+from memory_budget import MemoryBudget, open_image, is_out_of_memory
+from process_videos import process_video
 import ofts_database as ofts_db
+import ofts_shards
+import caption_vectors
 
 # HOME DIR
 home = Path.home()
@@ -27,12 +33,157 @@ console = Console()
 # MIME object
 mime = magic.Magic(mime=True)
 
+# Number of added images after which the search index is merged
+MAINTENANCE_BATCH = 500
+
+# Encoder of the caption vectors chosen on the command line, None to keep the one of the library
+CAPTION_ENCODER = None
+
+def use_shard(name: str, cross_shard_faces: bool = False):
+    """
+        Point ingestion, naming and the per-library searches at a shard
+        Args:
+            name (str): the name of the shard
+            cross_shard_faces (bool): match faces against the KNOWN_EMBEDDINGS of the other attached shards too
+        Returns:
+            dict: the shard, None if there is no such shard
+    """
+    global DB_PATH
+    shard = ofts_shards.get_shard(name)
+    if shard is None:
+        console.print(f"Unknown library: {name}", style="bold red")
+        return None
+
+    DB_PATH = shard["db_path"]
+    shared_folders = [other["embeddings_dir"] for other in ofts_shards.list_shards()] if cross_shard_faces else []
+    use_known_embedding_folder(shard["embeddings_dir"], shared_folders)
+    return shard
+
+def clean_caption(caption: str):
+    """
+        Remove all special characters and lowercase everything
+        Args:
+            caption (str): the caption from GIT
+        Returns:
+            str: the cleaned caption
+    """
+    caption = ''.join(e for e in caption if e.isalnum() or e.isspace())
+    return caption.lower()
+
+def caption_image(image_path: str, image):
+    """
+        Caption a single already decoded image, for when the batch failed
+        Args:
+            image_path (str): the path to the image
+            image (PIL.Image): the decoded image
+        Returns:
+            str: the caption, None if the image could not be captioned
+    """
+    try:
+        return tag_images_GIT([image])[0]
+    except Exception as e:
+        console.print(f"Could not caption {image_path}, skipping it: {e}", style="bold red")
+        return None
+
+def skip_file(file_name: str, error: Exception, budget: MemoryBudget):
+    """
+        Report a file that could not be processed, and shrink the batches if it ran out of memory
+        Args:
+            file_name (str): the name of the file
+            error (Exception): the error
+            budget (MemoryBudget): the memory budget of the ingestion
+        Returns:
+            None
+    """
+    if is_out_of_memory(error):
+        budget.shrink()
+        console.print(f"Not enough memory for {file_name}, skipping it.", style="bold red")
+    else:
+        console.print(f"Could not read {file_name}, skipping it: {error}", style="bold red")
+
+def store_images(pending: list, budget: MemoryBudget):
+    """
+        Caption a batch of images and add them to the database
+        A broken image is skipped, the rest of the batch is still added.
+        Args:
+            pending (list): a list of (image_path, faces) tuples waiting for a caption
+            budget (MemoryBudget): the memory budget of the ingestion
+        Returns:
+            int: the number of images added
+    """
+    # Decode every image on its own, so a file PIL can't read only loses that file
+    images = []
+    for image_path, faces in pending:
+        try:
+            images.append((image_path, faces, open_image(image_path, budget.max_pixels)))
+        except Exception as e:
+            console.print(f"Could not read {image_path}, skipping it: {e}", style="bold red")
+    if not images:
+        return 0
+
+    try:
+        captions = tag_images_GIT([image for _, _, image in images])
+    except Exception as e:
+        # Not enough memory for the whole batch, or one image the model can't handle:
+        # caption one (already downscaled) image at a time so the others aren't lost
+        if is_out_of_memory(e):
+            budget.shrink()
+        captions = [caption_image(image_path, image) for image_path, _, image in images]
+    pending = [(image_path, faces) for (image_path, faces, _), caption in zip(images, captions) if caption is not None]
+    captions = [caption for caption in captions if caption is not None]
+
+    # The decoded images aren't needed anymore
+    del images
+
+    # If DB_PATH doesn't exist create it and add faces, caption to database
+    if not os.path.exists(DB_PATH):
+        ofts_db.initialize_database(db_path=DB_PATH)
+    added = []
+    for (image_path, faces), caption in zip(pending, captions):
+        caption = clean_caption(caption)
+        added.append((ofts_db.add_image(image_path, faces, caption, db_path=DB_PATH), caption))
+
+    # Caption vectors for the hybrid search, missing ones are filled in later by backfill_vectors
+    try:
+        caption_vectors.add_caption_vectors(DB_PATH, added, caption_vectors.encoder_for(DB_PATH, CAPTION_ENCODER))
+    except Exception as e:
+        console.print(f"Could not encode the captions: {e}", style="bold red")
+
+    budget.update()
+    return len(pending)
+
+def use_caption_encoder(name: str):
+    """
+        Choose the encoder of the caption vectors, backfill_vectors re-encodes libraries that used another one
+        Args:
+            name (str): the name of the encoder
+        Returns:
+            None
+    """
+    global CAPTION_ENCODER
+    CAPTION_ENCODER = name
+
+def worker_of(file_path: str, num_workers: int):
+    """
+        The process that handles a file when several processes share the library
+        Every file belongs to exactly one process, the same one on every run.
+        Args:
+            file_path (str): the path to the file
+            num_workers (int): the number of processes sharing the library
+        Returns:
+            int: the index of the process
+    """
+    return zlib.crc32(file_path.encode()) % num_workers
+
 # Walk through all the files in the directory
 def walk_through_files(
         directory_path: str,
         model_name: str,
         distance_metric: str,
-        threshold: float
+        threshold: float,
+        worker_index: int = 0,
+        num_workers: int = 1,
+        memory_budget: int = None
     ):
     """
         Walk through all the files in the directory
@@ -41,35 +192,92 @@ def walk_through_files(
             model_name (str): the name of the model for DeepFace
             distance_metric (str): the distance metric
             threshold (str): the threshold value
+            worker_index (int): the index of this process when several processes share the library
+            num_workers (int): the number of processes sharing the library
+            memory_budget (int): the memory budget in bytes, batch sizes adapt to stay under it
         Returns:
             None
     """
-    try:
-        for (dirpath, dirnames, filenames) in track(walk(directory_path), description="Processing..."):
-            for f in filenames:
-                # Get the MIME type of the file
-                filename = mime.from_file(f"{dirpath}/{f}")
-
-                # Check if the file is a video or an image
-                if filename.find("video") != -1:
-                    pass
-                elif filename.find("image") != -1:
-                    # Get the faces and caption of the image
-                    faces = rec_face_image(f"{dirpath}/{f}", model_name, distance_metric, threshold)
-                    caption = tag_image_GIT(f"{dirpath}/{f}")
-
-                    # Remove all special characters and lowercase everything
-                    caption = ''.join(e for e in caption if e.isalnum() or e.isspace())
-                    caption = caption.lower()
-
-                    # If DB_PATH doesn't exist create it and add faces, caption to database
-                    if not os.path.exists(DB_PATH):
-                        ofts_db.initialize_database(db_path=DB_PATH)
-                    ofts_db.add_image(f"{dirpath}/{f}", faces, caption, db_path=DB_PATH)
-                else:
-                    console.print(f"Unknown file type: {f}", style="bold red")
-    except Exception as e:
-        console.print(e, style="bold red")
+    # Every process gets an equal share of the cores
+    configure_cpu_threads(num_workers=num_workers)
+    budget = MemoryBudget(memory_budget)
+    added = 0
+
+    # Images with their faces, waiting to be captioned as one batch
+    # The queue never grows past the batch size of the budget
+    pending = []
+
+    # Other processes may add images to the same library, the full maintenance waits until all of them are done
+    with ofts_db.ingestion_lock(DB_PATH):
+        try:
+            for (dirpath, dirnames, filenames) in track(walk(directory_path), description="Processing..."):
+                for f in filenames:
+                    # Only the files of this process
+                    if worker_of(f"{dirpath}/{f}", num_workers) != worker_index:
+                        continue
+
+                    # Get the MIME type of the file
+                    filename = mime.from_file(f"{dirpath}/{f}")
+
+                    # Check if the file is a video or an image
+                    if filename.find("video") != -1:
+                        # Run the keyframes through the face and caption stages
+                        if not os.path.exists(DB_PATH):
+                            ofts_db.initialize_database(db_path=DB_PATH)
+                        try:
+                            process_video(f"{dirpath}/{f}", model_name, distance_metric, threshold, db_path=DB_PATH, batch_size=budget.batch_size, budget=budget)
+                        except Exception as e:
+                            skip_file(f, e, budget)
+                        budget.update()
+                    elif filename.find("image") != -1:
+                        # Get the faces of the image, the caption is done with the rest of the batch
+                        try:
+                            faces = rec_face_image(f"{dirpath}/{f}", model_name, distance_metric, threshold, max_pixels=budget.max_pixels)
+                        except Exception as e:
+                            skip_file(f, e, budget)
+                            continue
+                        pending.append((f"{dirpath}/{f}", faces))
+                        if len(pending) < budget.batch_size:
+                            continue
+
+                        # Keep the number of FTS5 segments low while adding
+                        batch, pending = pending, []
+                        stored = store_images(batch, budget)
+                        if (added + stored) // MAINTENANCE_BATCH > added // MAINTENANCE_BATCH:
+                            ofts_db.merge_index(DB_PATH)
+                        added += stored
+                    else:
+                        console.print(f"Unknown file type: {f}", style="bold red")
+        except Exception as e:
+            console.print(e, style="bold red")
+
+        # The last batch, also after an error so the recognized faces aren't lost
+        added += store_images(pending, budget)
+
+    # Full index maintenance after a large batch (of all the processes together), done by the last
+    # process to finish, the others only merge the index
+    if added * num_workers >= MAINTENANCE_BATCH:
+        maintain_database()
+
+def maintain_database():
+    """
+        Optimizes the search index (FTS5 optimize, ANALYZE and VACUUM), or only merges it while images are being added
+        Args:
+            None
+        Returns:
+            None
+    """
+    if os.path.exists(DB_PATH):
+        # Rebuilding the photos table under a process that is adding images would lose its writes
+        with ofts_db.ingestion_lock(DB_PATH, exclusive=True) as locked:
+            if locked:
+                console.print("Optimizing the search index...", style="bold blue")
+                ofts_db.optimize_database(DB_PATH)
+            else:
+                console.print("Images are being added, only merging the search index. Run --maintain once they are done.", style="bold red")
+                ofts_db.merge_index(DB_PATH)
+    else:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
 
 def search_image_using_query(query: str):
     """
@@ -79,13 +287,164 @@ def search_image_using_query(query: str):
         Returns:
             list: a list of tuples
     """
-    if os.path.exists(DB_PATH):
-        results = ofts_db.search_images(query, DB_PATH)
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        # Search every attached library at once
+        results = ofts_shards.search_all_shards(query)
+        return results
+    else:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+
+def search_image_hybrid(query: str, top_k: int = 50):
+    """
+        Searches for images by the words and the meaning of the query
+        Args:
+            query (str): the text to search
+            top_k (int): the number of images to return
+        Returns:
+            list: a list of tuples, best first
+    """
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        # The fused scores are normalized per library, so they can be merged
+        results = ofts_shards.fan_out(lambda db_path: caption_vectors.hybrid_search(db_path, query, top_k))
+        results.sort(key=lambda result: result[3], reverse=True)
+        return [(image_path, faces, caption) for image_path, faces, caption, score in results[:top_k]]
+    else:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+
+def backfill_vectors():
+    """
+        Encodes the stored captions that don't have a caption vector yet, for every attached library
+        Args:
+            None
+        Returns:
+            None
+    """
+    for shard in ofts_shards.list_shards():
+        if os.path.exists(shard["db_path"]):
+            console.print(f"Encoding the captions of {shard['name']}...", style="bold blue")
+            caption_vectors.backfill_caption_vectors(shard["db_path"], CAPTION_ENCODER)
+
+def search_videos_using_query(query: str):
+    """
+        Searches for video frames in ofts database
+        Args:
+            query (str): the text to search
+        Returns:
+            list: a list of (video_path, timestamp, faces, caption) tuples
+    """
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        results = ofts_shards.fan_out(lambda db_path: ofts_db.search_video_frames(query, db_path))
         return results
     else:
         console.print("You need to run Image tagging and face recognition first.", style="bold red")
         return None
 
+def search_images_by_people(include: list, exclude: list = None):
+    """
+        Searches for images with all the people in include and none of the people in exclude
+        Args:
+            include (list): the people that must be in the image
+            exclude (list): the people that must not be in the image
+        Returns:
+            list: a list of tuples
+    """
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        def search(db_path):
+            # Databases from older versions don't have the person index yet
+            ofts_db.rebuild_person_index(db_path)
+            return ofts_db.search_people(db_path, include, exclude)
+        results = ofts_shards.fan_out(search)
+        return results
+    else:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+
+def people_seen_with(person: str, limit: int = 10):
+    """
+        Finds the people who appear most often with the given person
+        Args:
+            person (str): the person to look for
+            limit (int): the maximum number of people
+        Returns:
+            list: a list of (person, count) tuples
+    """
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        def search(db_path):
+            # Databases from older versions don't have the person index yet
+            ofts_db.rebuild_person_index(db_path)
+            return ofts_db.co_occurring_people(db_path, person, limit=None)
+
+        # The same person can appear with the person in several libraries
+        counts = {}
+        for other, count in ofts_shards.fan_out(search):
+            counts[other] = counts.get(other, 0) + count
+        results = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return results
+    else:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+
+def search_similar_images(
+        query: str,
+        model_name: str,
+        distance_metric: str,
+        top_k: int = 20
+    ):
+    """
+        Finds the photos with the faces most similar to a given image or known face
+        Args:
+            query (str): the path to an image, the name of a face, or the unique id of a face in KNOWN_EMBEDDINGS
+            model_name (str): the name of the model for DeepFace
+            distance_metric (str): the distance metric
+            top_k (int): the number of photos to return
+        Returns:
+            list: a list of tuples, the most similar first
+    """
+    if not os.path.exists(DB_PATH) and len(ofts_shards.list_shards()) <= 1:
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+    shards = {shard["db_path"]: shard for shard in ofts_shards.list_shards() if os.path.exists(shard["db_path"])}
+
+    # Known faces (by unique id or by name, in any library) reuse their stored embeddings,
+    # only a new image needs DeepFace
+    query_embeddings = []
+    for db_path, shard in shards.items():
+        face_names = ofts_db.get_face_names(db_path)
+        known_ids = [query] + [face_id for face_id, face_name in face_names.items() if ofts_db.person_key(face_name) == ofts_db.person_key(query)]
+        for face_id in dict.fromkeys(known_ids):
+            if os.path.isdir(os.path.join(shard["embeddings_dir"], face_id)):
+                query_embeddings += identity_embeddings(face_id, shard["embeddings_dir"])
+    if not query_embeddings:
+        query_embeddings = embed_image(query, model_name)
+        if query_embeddings is None:
+            console.print(f"{query} is not an image or a known face.", style="bold red")
+            return []
+
+    def search(db_path):
+        # The closest identities of the library, as they are named in its database
+        face_names = ofts_db.get_face_names(db_path)
+        distances = {}
+        for unique_id, distance in find_similar_identities(query_embeddings, distance_metric, top_k, shards[db_path]["embeddings_dir"]):
+            person = face_names.get(unique_id, unique_id)
+            distances[person] = min(distance, distances.get(person, float('inf')))
+
+        ofts_db.rebuild_person_index(db_path)
+        return [
+            (distances[person], image_path, faces, caption)
+            for person, image_path, faces, caption in ofts_db.images_of_people(db_path, list(distances))
+        ]
+
+    # A photo is as close as the closest person in it
+    photos = {}
+    for distance, image_path, faces, caption in ofts_shards.fan_out(search, list(shards.values())):
+        if image_path not in photos or distance < photos[image_path][0]:
+            photos[image_path] = (distance, faces, caption)
+
+    ranked = sorted(photos.items(), key=lambda item: item[1][0])[:top_k]
+    return [(image_path, faces, caption) for image_path, (distance, faces, caption) in ranked]
+
 def change_face_name(face_id: str, face_name: str):
     """
         Changes the face_id to face_name in the OFTS database
@@ -102,6 +461,50 @@ def change_face_name(face_id: str, face_name: str):
         console.print("You need to run Image tagging and face recognition first.", style="bold red")
         return None
 
+def bulk_change_face_names(face_names: dict):
+    """
+        Changes many face_ids to face_names in one go and merges the faces that got the same name
+        Args:
+            face_names (dict): a mapping of face_id -> face_name
+        Returns:
+            int: the number of images that were updated, None if the names couldn't be changed
+    """
+    if not os.path.exists(DB_PATH):
+        console.print("You need to run Image tagging and face recognition first.", style="bold red")
+        return None
+
+    # Only known faces can be named, and names can't contain spaces (the faces column is space separated)
+    face_counts = {unique_id: face_count for unique_id, face_count, _ in list_identities()}
+    unknown = [face_id for face_id in face_names if face_id not in face_counts]
+    if unknown:
+        console.print(f"Skipping unknown faces: {', '.join(unknown)}", style="bold red")
+    face_names = {
+        face_id: ofts_db.normalize_face_name(face_name)
+        for face_id, face_name in face_names.items()
+        if face_id in face_counts and ofts_db.normalize_face_name(face_name)
+    }
+
+    # Group the faces by their name after this change, including faces that were named the same before
+    groups = {}
+    for face_id, face_name in {**ofts_db.get_face_names(DB_PATH), **face_names}.items():
+        if face_name in face_names.values() and face_id in face_counts:
+            groups.setdefault(face_name, []).append(face_id)
+    for face_name, face_ids in groups.items():
+        face_ids.sort(key=lambda face_id: face_counts[face_id], reverse=True)
+        for face_id in face_ids:
+            face_names[face_id] = face_name
+
+    # The database is written first, if it fails the embeddings are left as they were
+    updated = ofts_db.name_faces_bulk(db_path=DB_PATH, face_names=face_names)
+    if updated is None:
+        return None
+
+    # Merge every group into the identity with the most faces, so later matching uses all the embeddings
+    for face_ids in groups.values():
+        if len(face_ids) > 1:
+            merge_identities(face_ids)
+    return updated
+
 def show_all_images_at_once():
     """
         Shows all the images in the OFTS database
@@ -110,8 +513,8 @@ def show_all_images_at_once():
         Returns:
             list: a list of tuples
     """
-    if os.path.exists(DB_PATH):
-        results = ofts_db.show_all_at_once(db_path=DB_PATH)
+    if os.path.exists(DB_PATH) or len(ofts_shards.list_shards()) > 1:
+        results = ofts_shards.fan_out(lambda db_path: ofts_db.show_all_at_once(db_path=db_path))
         return results
     else:
         console.print("You need to run Image tagging and face recognition first.", style="bold red")
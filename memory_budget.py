@@ -0,0 +1,179 @@
+# Import the built-in libraries
+import os
+import gc
+import sys
+import resource
+
+# Import the external libraries
+import cv2
+from PIL import Image
+
+# Both the face and the caption stage resize the image to a few hundred pixels,
+# so images above this many pixels are downscaled while they are decoded
+DECODE_PIXELS = 2_000_000
+
+# The face stage works on 300x300 images, never decode less than that
+MIN_DECODE_PIXELS = 300 * 300
+
+# Share of the budget one decoded image may use (RGB, decoded by both cv2 and PIL)
+IMAGE_SHARE = 8
+
+# torch and tensorflow report a failed allocation with their own errors instead of MemoryError
+OUT_OF_MEMORY_MESSAGES = ("can't allocate memory", "out of memory", "oom when allocating", "failed to allocate")
+
+def parse_size(size: str):
+    """
+        Parse a memory size like 512M, 4G or 4096 (megabytes)
+        Args:
+            size (str): the size
+        Returns:
+            int: the size in bytes
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size) * units["M"])
+
+def is_out_of_memory(error: Exception):
+    """
+        Whether an error means the process ran out of memory, e.g. torch's RuntimeError
+        "DefaultCPUAllocator: can't allocate memory"
+        Args:
+            error (Exception): the error
+        Returns:
+            bool: True for a MemoryError or a failed allocation of the models
+    """
+    if isinstance(error, MemoryError):
+        return True
+    message = str(error).lower()
+    return any(part in message for part in OUT_OF_MEMORY_MESSAGES)
+
+def current_rss():
+    """
+        The resident memory of this process
+        Args:
+            None
+        Returns:
+            int: the resident set size in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Not Linux, the peak is the best we have (in bytes on macOS, in kilobytes elsewhere)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def pixel_count(image_path: str):
+    """
+        The number of pixels of an image, read from the header without decoding it
+        Args:
+            image_path (str): the path to the image
+        Returns:
+            int: width * height
+    """
+    with Image.open(image_path) as image:
+        width, height = image.size
+    return width * height
+
+def open_image(image_path: str, max_pixels: int = DECODE_PIXELS):
+    """
+        Open an image with PIL, downscaling oversized images while they are decoded
+        Args:
+            image_path (str): the path to the image
+            max_pixels (int): the maximum number of pixels to decode
+        Returns:
+            PIL.Image: the RGB image
+    """
+    image = Image.open(image_path)
+    width, height = image.size
+    if width * height > max_pixels:
+        scale = (max_pixels / (width * height)) ** 0.5
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+        # JPEGs are decoded at 1/2, 1/4 or 1/8 scale directly, the rest is reduced after decoding
+        image.draft("RGB", size)
+        image.thumbnail(size)
+    return image.convert("RGB")
+
+def read_image(image_path: str, max_pixels: int = DECODE_PIXELS):
+    """
+        Same as cv2.imread, but oversized images are decoded at a reduced scale
+        Args:
+            image_path (str): the path to the image
+            max_pixels (int): the maximum number of pixels to decode
+        Returns:
+            np.ndarray: the BGR image
+    """
+    try:
+        pixels = pixel_count(image_path)
+    except OSError:
+        # PIL can't read the header, let cv2 try the whole file
+        return cv2.imread(image_path)
+    if pixels <= max_pixels:
+        return cv2.imread(image_path)
+
+    # The smallest reduction that fits, 1/8 at most
+    for factor, flag in ((2, cv2.IMREAD_REDUCED_COLOR_2), (4, cv2.IMREAD_REDUCED_COLOR_4)):
+        if pixels / (factor * factor) <= max_pixels:
+            return cv2.imread(image_path, flag)
+    return cv2.imread(image_path, cv2.IMREAD_REDUCED_COLOR_8)
+
+class MemoryBudget:
+    """
+        Keeps the ingestion under a memory budget
+        Batch sizes grow by one while there is room and are halved when the RSS gets close to
+        the budget, so the throughput stays as high as the budget allows.
+    """
+
+    def __init__(
+            self,
+            budget: int = None,
+            batch_size: int = 4,
+            max_batch_size: int = 16
+        ):
+        """
+            Args:
+                budget (int): the budget in bytes, None for no budget
+                batch_size (int): the starting batch size
+                max_batch_size (int): the largest batch size
+        """
+        self.budget = budget
+        self.max_batch_size = max_batch_size
+        self.batch_size = min(batch_size, max_batch_size)
+
+    @property
+    def max_pixels(self):
+        """
+            The largest image that is decoded at full size, smaller for small budgets
+        """
+        if self.budget is None:
+            return DECODE_PIXELS
+        return max(MIN_DECODE_PIXELS, min(DECODE_PIXELS, self.budget // (IMAGE_SHARE * 3 * 2)))
+
+    def update(self):
+        """
+            Adapt the batch size to the current RSS, call it after every batch
+            Returns:
+                int: the new batch size
+        """
+        if self.budget is None:
+            return self.batch_size
+
+        rss = current_rss()
+        if rss > 0.9 * self.budget:
+            self.shrink()
+        elif rss < 0.6 * self.budget and self.batch_size < self.max_batch_size:
+            self.batch_size += 1
+        return self.batch_size
+
+    def shrink(self):
+        """
+            Halve the batch size and give the freed memory back, e.g. after a failed allocation
+            Returns:
+                int: the new batch size
+        """
+        self.batch_size = max(1, self.batch_size // 2)
+        gc.collect()
+        return self.batch_size
@@ -1,5 +1,6 @@
 # Import the built-in libraries
-import os, subprocess
+import os, subprocess, sys
+import argparse
 from pathlib import Path
 import time
 import json
@@ -12,6 +13,9 @@ from rich.table import Table
 from rich.progress import Progress
 import sqlite3
 
+# import the local files
+from memory_budget import parse_size
+
 # Create a console object
 console = Console()
 
@@ -19,7 +23,13 @@ console = Console()
 #console.print("Importing the local files...", style="bold blue")
 with Progress() as progress:
     task1 = progress.add_task("[cyan]Loading the necessary libraries...", total=100)
-    from main import walk_through_files, show_all_images_at_once, search_image_using_query, change_face_name
+    from main import walk_through_files, show_all_images_at_once, search_image_using_query, bulk_change_face_names, list_identities
+    from main import search_images_by_people, people_seen_with, search_similar_images, search_videos_using_query
+    from main import maintain_database, use_shard, search_image_hybrid, backfill_vectors, use_caption_encoder
+    from caption_vectors import ENCODERS
+    from caption_images import use_cpu_optimized
+    import ofts_shards
+    import main
     progress.update(task1, advance=100)
 
 # HOME DIR
@@ -43,24 +53,77 @@ THRESHOLDS = {
 if not os.path.exists(f"{home}/.ofts"):
     os.makedirs(f"{home}/.ofts")
 
+# Non-interactive mode: python3 ofts_cli.py --with alice bob --without carol
+parser = argparse.ArgumentParser(description="OFTS - A simple Google photos alternative that run in the terminal")
+parser.add_argument("--with", dest="with_people", nargs="+", metavar="PERSON", help="show the images with all these people")
+parser.add_argument("--without", dest="without_people", nargs="+", metavar="PERSON", default=[], help="leave out the images with any of these people")
+parser.add_argument("--seen-with", metavar="PERSON", help="show who appears most often with this person")
+parser.add_argument("--limit", type=int, default=10, help="the number of people shown by --seen-with")
+parser.add_argument("--similar", metavar="IMAGE_OR_FACE_ID", help="show the images with faces similar to an image or a known face")
+parser.add_argument("--top-k", type=int, default=20, help="the number of images shown by --similar and --hybrid")
+parser.add_argument("--maintain", action="store_true", help="optimize the search index")
+parser.add_argument("--hybrid", metavar="QUERY", help="show the images matching the words and the meaning of the query")
+parser.add_argument("--backfill-vectors", action="store_true", help="encode the stored captions that don't have a caption vector yet")
+parser.add_argument("--caption-encoder", choices=sorted(ENCODERS), help="the encoder of the caption vectors (hashing needs no download)")
+
+# Libraries: every library root has its own database and KNOWN_EMBEDDINGS, searches go through all of them
+parser.add_argument("--library", metavar="NAME", help="tag, name faces and search in this library (default: the first library)")
+parser.add_argument("--cross-library-faces", action="store_true", help="match faces against the faces of all the attached libraries")
+parser.add_argument("--add-library", nargs=2, metavar=("NAME", "ROOT"), help="create a new library for a directory")
+parser.add_argument("--attach-library", nargs=3, metavar=("NAME", "DIR", "ROOT"), help="attach an existing library directory (DIR) for the photos in ROOT without reindexing")
+parser.add_argument("--reattach-library", metavar="NAME", help="attach a detached library again")
+parser.add_argument("--detach-library", metavar="NAME", help="leave a library out of searches, its files are kept")
+parser.add_argument("--list-libraries", action="store_true", help="show all the libraries")
+parser.add_argument("--ingest", action="store_true", help="run image tagging and face recognition on the library root with the initial settings")
+
+# Several --ingest processes can share one library: python3 ofts_cli.py --ingest --workers 4 --worker-index 0..3
+parser.add_argument("--workers", type=int, default=1, help="the number of --ingest processes sharing the library")
+parser.add_argument("--worker-index", type=int, default=0, help="the index of this --ingest process (0 to workers-1)")
+parser.add_argument("--cpu-optimized", action="store_true", help="caption with the int8 quantized GIT model (faster on the CPU, captions may differ slightly)")
+parser.add_argument("--memory-budget", type=parse_size, metavar="SIZE", help="keep image tagging under this much memory, e.g. 4G or 512M")
+args = parser.parse_args()
+if not 0 <= args.worker_index < args.workers:
+    parser.error("--worker-index must be between 0 and --workers - 1")
+NON_INTERACTIVE = any([
+    args.with_people, args.seen_with, args.similar, args.maintain, args.add_library, args.attach_library,
+    args.reattach_library, args.detach_library, args.list_libraries, args.ingest, args.hybrid, args.backfill_vectors,
+])
+if args.caption_encoder:
+    use_caption_encoder(args.caption_encoder)
+if args.cpu_optimized:
+    use_cpu_optimized()
+
+# The catalog is written once here, the searches only read it
+ofts_shards.initialize_catalog()
+
+# Use the chosen library for everything that works on a single library
+library = None
+if args.library and use_shard(args.library, args.cross_library_faces) is None:
+    sys.exit(1)
+if args.library:
+    library = ofts_shards.get_shard(args.library)
+
 # OFTS - A simple Google photos alternative that run in the terminal
 # This is the main file for the OFTS CLI application
 console.print("OFTS - A simple Google photos alternative that run in the terminal", style="bold green")
 
-# The whole process takes a loooong time, grab a coffee and relax
-console.print("NOTE: The whole process takes a loooong time, grab a cup of coffee and relax", style="bold red")
-
 # The OFTS CLI is divided into two parts:
 # 1. Image tagging and face recognition
 # 2. Image searching
-print("\n")
-console.print("What do you want to do?", style="bold blue")
-console.print("1. Image tagging and face recognition (Do this first)", style="")
-console.print("2. Image searching", style="")
-console.print("3. Name faces", style="")
-console.print("4. Search Images with a frontend", style="")
-choice = input("Enter your choice (1/2/3/4): ")
-print("\n")
+choice = None
+if not NON_INTERACTIVE:
+    # The whole process takes a loooong time, grab a coffee and relax
+    console.print("NOTE: The whole process takes a loooong time, grab a cup of coffee and relax", style="bold red")
+
+    print("\n")
+    console.print("What do you want to do?", style="bold blue")
+    console.print("1. Image tagging and face recognition (Do this first)", style="")
+    console.print("2. Image searching", style="")
+    console.print("3. Name faces", style="")
+    console.print("4. Search Images with a frontend", style="")
+    console.print("5. Optimize the search index", style="")
+    choice = input("Enter your choice (1/2/3/4/5): ")
+    print("\n")
 # from here, the program goes to line 170
 
 # intial function
@@ -154,14 +217,20 @@ def initial_image_tagging():
     conn.commit()
     conn.close()
 
+    # The default library gets the chosen directory as its root
+    ofts_shards.initialize_catalog()
+
     # Run the image tagging and face recognition process
-    run_image_tagging(directory_path, models[int(model_name)-1], distance_metrics[int(distance_metric)-1], threshold)
+    run_image_tagging(directory_path, models[int(model_name)-1], distance_metrics[int(distance_metric)-1], threshold, memory_budget=args.memory_budget)
 
 def run_image_tagging(
         directory_path: str,
         model_name: str,
         distance_metric: str,
-        threshold: float
+        threshold: float,
+        worker_index: int = 0,
+        num_workers: int = 1,
+        memory_budget: int = None
     ):
     """
         Run the image tagging and face recognition process
@@ -170,10 +239,13 @@ def run_image_tagging(
             model_name (str): the name of the model for DeepFace
             distance_metric (str): the distance metric
             threshold (str): the threshold value
+            worker_index (int): the index of this process when several processes share the library
+            num_workers (int): the number of processes sharing the library
+            memory_budget (int): the memory budget in bytes
         Returns:
             None
     """
-    walk_through_files(directory_path, model_name, distance_metric, float(threshold))
+    walk_through_files(directory_path, model_name, distance_metric, float(threshold), worker_index, num_workers, memory_budget)
     console.print("Completed successfully.", style="bold green")
     console.print("Now, Name the faces to search through images with names and tags", style="bold green")
 
@@ -188,7 +260,11 @@ def image_searching():
     console.print("Choose the search method: ", style="bold blue")
     console.print("1. Show all images at once and use fzf to search for image (May take some time to load)", style="")
     console.print("2. Enter a query to search for the image (Faster, but need to run the cli again to search for another query)", style="")
-    show_all = input("Enter your choice (1/2): ")
+    console.print("3. Search for images with (and without) some people", style="")
+    console.print("4. Find who appears most often with a person", style="")
+    console.print("5. Find images with faces similar to a face or an image", style="")
+    console.print("6. Enter a query to search for the image by meaning (\"seaside\" also finds \"a beach with waves\")", style="")
+    show_all = input("Enter your choice (1/2/3/4/5/6): ")
     if show_all.strip() == "1":
         results = show_all_images_at_once()
         fzf_preview(results)
@@ -196,53 +272,246 @@ def image_searching():
         console.print("Enter your query: ", style="bold blue")
         query = input(">> ")
 
-        # Stop words
-        stop_words = {
-        "a", "an", "and", "are", "as", "at", "be", "by", "for", "from",
-        "has", "he", "in", "is", "it", "its", "of", "on", "that", "the",
-        "to", "was", "were", "will", "with", "this", "have", "but", "not",
-        "they", "his", "her", "she", "him", "you", "your", "yours", "me",
-        "my", "i", "we", "our", "ours", "had", "been", "do", "does", "did",
-        "doing", "am", "all", "any", "more", "most", "other", "some", "such",
-        "no", "nor", "only", "own", "same", "so", "than", "too", "very",
-        "can", "will", "just", "don", "should", "now", "linkedin", "instagram",
-        "facebook", "join", "us"
-    }
-
-        # Remove the stop words from the query
-        words = query.split()
-        filtered_words = [word for word in words if word.lower() not in stop_words]
-        query =  " ".join(filtered_words)
-
         # Search for the images using the query
         results = search_image_using_query(query)
 
+        # Videos can't be previewed with kitty icat, so list the matching timestamps
+        video_results = search_videos_using_query(query)
+        if video_results:
+            vtable = Table(title="Videos")
+            vtable.add_column("Video", style="bold")
+            vtable.add_column("Time", style="bold")
+            vtable.add_column("Faces", style="")
+            vtable.add_column("Caption", style="")
+            for video_path, timestamp, faces, caption in video_results:
+                vtable.add_row(video_path, time.strftime("%H:%M:%S", time.gmtime(float(timestamp))), faces, caption)
+            console.print(vtable)
+
         # Display the results
         if len(results) == 0:
             console.print("No images found.", style="bold red")
         else:
             fzf_preview(results)
+    elif show_all.strip() == "3":
+        console.print("Enter the people that must be in the image (space separated): ", style="bold blue")
+        include = input(">> ").split()
+        console.print("Enter the people that must not be in the image (space separated, optional): ", style="bold blue")
+        exclude = input(">> ").split()
+
+        # Search for the images using the person index
+        results = search_images_by_people(include, exclude)
+        if not results:
+            console.print("No images found.", style="bold red")
+        else:
+            fzf_preview(results)
+    elif show_all.strip() == "4":
+        console.print("Enter the name of the person: ", style="bold blue")
+        person = input(">> ").strip()
+        show_people_seen_with(person)
+    elif show_all.strip() == "5":
+        console.print("1. Pick a known face", style="")
+        console.print("2. Enter the path to an image", style="")
+        method = input("Enter your choice (1/2): ")
+        query = pick_face() if method.strip() == "1" else os.path.expanduser(input(">> ").strip())
+        if not query:
+            console.print("No face selected. Exiting...", style="bold red")
+            return
+
+        # Search for the images using the stored embeddings
+        settings = read_initial_settings()
+        results = search_similar_images(query, settings[1], settings[2])
+        if not results:
+            console.print("No images found.", style="bold red")
+        else:
+            fzf_preview(results)
+    elif show_all.strip() == "6":
+        console.print("Enter your query: ", style="bold blue")
+        query = input(">> ")
+
+        # Search for the images using the FTS index and the caption vectors
+        results = search_image_hybrid(query)
+        if not results:
+            console.print("No images found.", style="bold red")
+        else:
+            fzf_preview(results)
     else:
         console.print("Invalid choice. Exiting...", style="bold red")
 
+def read_initial_settings():
+    """
+        Read the settings chosen during the first image tagging
+        Args:
+            None
+        Returns:
+            tuple: the directory, model, distance metric and threshold
+    """
+    conn = sqlite3.connect(f"{home}/.ofts/init_ofts.db")
+    c = conn.cursor()
+    c.execute("SELECT * FROM init_data")
+    data = c.fetchall()
+    conn.close()
+    return data[0]
+
+def library_directory(directory_path: str):
+    """
+        The directory to tag, the root of the library chosen with --library
+        Args:
+            directory_path (str): the directory from the initial settings
+        Returns:
+            str: the directory, None if the library has no root directory
+    """
+    if library:
+        directory_path = library["root"]
+    if not directory_path or not os.path.isdir(directory_path):
+        name = library["name"] if library else ofts_shards.DEFAULT_SHARD
+        console.print(f"Library {name} has no root directory ({directory_path or 'not set'}), attach it again with --attach-library NAME DIR ROOT.", style="bold red")
+        return None
+    return directory_path
+
+def pick_face():
+    """
+        Pick a known face with fzf and kitty icat
+        Args:
+            None
+        Returns:
+            str: the unique id of the picked face, None if nothing was picked
+    """
+    faces = [(unique_id, face_count, face_image) for unique_id, face_count, face_image in list_identities() if face_image]
+    fzf_cmd = [
+        'fzf',
+        '--reverse',
+        '--preview',
+        'kitty icat --clear --transfer-mode=memory --stdin=no --place=${FZF_PREVIEW_COLUMNS}x${FZF_PREVIEW_LINES}@0x0  "$(echo {} | sed "s/.*||//")"',
+        '--delimiter',
+        '||',
+    ]
+    fzf_input = '\n'.join([f"{unique_id}  |  {face_count} faces          ||{face_image}" for unique_id, face_count, face_image in faces]).encode('utf-8')
+    selected_face = subprocess.run(fzf_cmd, input=fzf_input, stdout=subprocess.PIPE)
+    selected = selected_face.stdout.decode('utf-8').strip()
+    if not selected:
+        return None
+    return os.path.basename(os.path.dirname(selected.split("||")[1]))
+
+def show_people_seen_with(person: str, limit: int = 10):
+    """
+        Show the people who appear most often with a person in a table
+        Args:
+            person (str): the person to look for
+            limit (int): the number of people to show
+        Returns:
+            None
+    """
+    results = people_seen_with(person, limit)
+    if not results:
+        console.print("No one found.", style="bold red")
+        return
+    rtable = Table(title=f"Seen with {person}")
+    rtable.add_column("Person", style="bold")
+    rtable.add_column("Images", style="bold")
+    for other, count in results:
+        rtable.add_row(other, str(count))
+    console.print(rtable)
+
+def non_interactive(args: argparse.Namespace):
+    """
+        Run the search given on the command line and print the results
+        Args:
+            args (argparse.Namespace): the parsed command line arguments
+        Returns:
+            None
+    """
+    if args.add_library:
+        name, root = args.add_library
+        ofts_shards.add_shard(name, os.path.abspath(os.path.expanduser(root)))
+        console.print(f"Library {name} created.", style="bold green")
+    if args.attach_library:
+        name, shard_dir, root = args.attach_library
+        ofts_shards.attach_shard(name, os.path.abspath(os.path.expanduser(shard_dir)), os.path.abspath(os.path.expanduser(root)))
+        console.print(f"Library {name} attached.", style="bold green")
+    if args.reattach_library:
+        ofts_shards.attach_shard(args.reattach_library)
+        console.print(f"Library {args.reattach_library} attached.", style="bold green")
+    if args.detach_library:
+        ofts_shards.detach_shard(args.detach_library)
+        console.print(f"Library {args.detach_library} detached.", style="bold green")
+    if args.list_libraries:
+        rtable = Table(title="Libraries")
+        rtable.add_column("Name", style="bold")
+        rtable.add_column("Root", style="")
+        rtable.add_column("Database", style="")
+        rtable.add_column("Attached", style="bold")
+        for shard in ofts_shards.list_shards(attached_only=False):
+            rtable.add_row(shard["name"], shard["root"], shard["db_path"], "yes" if shard["attached"] else "no")
+        console.print(rtable)
+    if args.ingest:
+        settings = read_initial_settings()
+        directory_path = library_directory(settings[0])
+        if directory_path:
+            run_image_tagging(directory_path, settings[1], settings[2], settings[3], args.worker_index, args.workers, args.memory_budget)
+    if args.backfill_vectors:
+        backfill_vectors()
+    if args.maintain:
+        maintain_database()
+    if args.hybrid:
+        results = search_image_hybrid(args.hybrid, args.top_k) or []
+        for image_path, faces, caption in results:
+            print(f"{image_path}\t{faces}\t{caption}")
+    if args.with_people:
+        results = search_images_by_people(args.with_people, args.without_people) or []
+        for image_path, faces, caption in results:
+            print(f"{image_path}\t{faces}\t{caption}")
+    if args.seen_with:
+        show_people_seen_with(args.seen_with, args.limit)
+    if args.similar:
+        settings = read_initial_settings()
+        results = search_similar_images(args.similar, settings[1], settings[2], args.top_k) or []
+        for image_path, faces, caption in results:
+            print(f"{image_path}\t{faces}\t{caption}")
+
 def face_naming():
     """
         Name the faces in the images
     """
-    count = 0
-    known_embedding_folder = f"{home}/.ofts/KNOWN_EMBEDDINGS"
-    for known_embedding in os.listdir(known_embedding_folder):
-        for image in os.listdir(f"{known_embedding_folder}/{known_embedding}"):
-            if image.endswith(".png"):
-                os.system(f"kitty icat {known_embedding_folder}/{known_embedding}/{image}")
-                console.print("Name the above face: ", style="bold blue")
-                if count == 0:
-                    console.print("TIP: If you get the same face twice, name them same. It will help when searching the image.", style="bold red")
-                    count += 1
-                face_name = input(">> ")
-                change_face_name(face_id=known_embedding, face_name=face_name)
+    console.print("Choose the naming method: ", style="bold blue")
+    console.print("1. Name the faces one by one (the faces seen most often come first)", style="")
+    console.print("2. Load the names from a JSON file ({\"face_id\": \"name\", ...})", style="")
+    method = input("Enter your choice (1/2): ")
+
+    face_names = {}
+    if method.strip() == "2":
+        console.print("Enter the path to the JSON file: ", style="bold blue")
+        try:
+            with open(os.path.expanduser(input(">> ").strip())) as f:
+                face_names = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            console.print(f"Could not read the names: {e}", style="bold red")
+            return
+        if not isinstance(face_names, dict) or not all(isinstance(name, str) for name in face_names.values()):
+            console.print("The JSON file must map face ids to names.", style="bold red")
+            return
+    elif method.strip() == "1":
+        console.print("TIP: If you get the same face twice, name them same. It will help when searching the image.", style="bold red")
+        console.print("TIP: Press enter to skip a face and type :q to stop naming.", style="bold red")
+        for known_embedding, face_count, face_image in list_identities():
+            if face_image is None:
+                continue
+            os.system(f"kitty icat {face_image}")
+            console.print(f"Name the above face ({face_count} faces): ", style="bold blue")
+            face_name = input(">> ").strip()
+            if face_name == ":q":
                 break
+            if face_name:
+                face_names[known_embedding] = face_name
+                if " " in face_name:
+                    console.print(f"Saved as {'_'.join(face_name.split())} (names can't contain spaces)", style="bold red")
+    else:
+        console.print("Invalid choice. Exiting...", style="bold red")
+        return
 
+    # Apply all the names at once
+    if bulk_change_face_names(face_names) is None:
+        console.print("The names could not be changed.", style="bold red")
+        return
     console.print("Names changed successfully!", style="bold green")
 
 def fzf_preview(results: list):
@@ -305,8 +574,8 @@ def fzf_preview(results: list):
         console.print("No image selected. Exiting...", style="bold red")
 
 def eject_to_json():
-    DB_PATH = f"{home}/.ofts/ofts.db"
-    conn = sqlite3.connect(DB_PATH)
+    # The database of the library chosen with --library
+    conn = sqlite3.connect(main.DB_PATH)
     conn.row_factory = sqlite3.Row
     db = conn.cursor()
 
@@ -333,7 +602,10 @@ def search_image_with_frontend():
     httpd.serve_forever()
 
 # User Choice
-if choice == "1":
+if NON_INTERACTIVE:
+    non_interactive(args)
+
+elif choice == "1":
     # Use the initial database if it already exists
     if os.path.exists(f"{home}/.ofts/init_ofts.db"):
         console.print("Using the existing database", style="bold green")
@@ -346,8 +618,8 @@ if choice == "1":
         data = c.fetchall()
         conn.close()
 
-        # Display the initial settings
-        directory_path = data[0][0]
+        # Display the initial settings, a library chosen with --library has its own directory
+        directory_path = library_directory(data[0][0])
         model_name = data[0][1]
         distance_metric = data[0][2]
         threshold = data[0][3]
@@ -359,7 +631,8 @@ if choice == "1":
         print("\n")
 
         # run the image tagging and face recognition process
-        run_image_tagging(directory_path, model_name, distance_metric, threshold)
+        if directory_path:
+            run_image_tagging(directory_path, model_name, distance_metric, threshold, memory_budget=args.memory_budget)
     else:
         # if init_db doesn't exist, go through inital config settings
         initial_image_tagging()
@@ -368,14 +641,16 @@ elif choice == "2":
     image_searching()
 
 elif choice=="3":
-    if not os.path.exists(f"{home}/.ofts/ofts.db"):
+    if not os.path.exists(main.DB_PATH):
         console.print("You need to run Image tagging and face recognition first.", style="bold red")
     else:
         face_naming()
 elif choice == "4":
-    if not os.path.exists(f"{home}/.ofts/ofts.db"):
+    if not os.path.exists(main.DB_PATH):
         console.print("You need to run Image tagging and face recognition first.", style="bold red")
     else:
         search_image_with_frontend()
+elif choice == "5":
+    maintain_database()
 else:
     console.print("Invalid choice. Please enter 1 or 2.", style="bold red")
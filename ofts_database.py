@@ -1,33 +1,272 @@
 # import the necessary libraries
 import sqlite3
 import os
+import re
+import time
+import fcntl
+from contextlib import contextmanager
 from rich.console import Console
 
 # Create a console object
 console = Console()
 
-def initialize_database(db_path: str):
+# Seconds a connection waits for another process holding the write lock
+BUSY_TIMEOUT = 30
+
+# Number of times a write is retried after the busy timeout ran out
+WRITE_RETRIES = 5
+
+# Stored in PRAGMA user_version once the tables below exist and are filled:
+# 1 = the person index is built, 2 = the type-ahead word list is built,
+# 3 = the person index is keyed by person_key
+SCHEMA_VERSION = 3
+
+# Prefix lengths indexed by FTS5, so "bea*" is answered from the index while typing
+FTS_PREFIX = (2, 3)
+
+# FTS5 tokenizer, porter stemming makes "beach" also match "beaches"
+FTS_TOKENIZER = "porter unicode61"
+
+# Columns that can be searched on their own, e.g. "faces:alice"
+FILTER_COLUMNS = ("faces", "caption")
+
+# Porter stems the indexed words but not a partial word ("beautiful" is indexed as "beauti",
+# so "beautif"* finds nothing). The last word is expanded to at most this many complete
+# words from the unstemmed search_words table, which the stemmer then handles.
+PREFIX_EXPANSION = 50
+
+# ORDER BY rank computes bm25 for every match, the hybrid search only ranks this many of them
+BM25_CANDIDATES = 10000
+
+# Stop words are dropped from queries, captions are full of them
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from",
+    "has", "he", "in", "is", "it", "its", "of", "on", "that", "the",
+    "to", "was", "were", "will", "with", "this", "have", "but", "not",
+    "they", "his", "her", "she", "him", "you", "your", "yours", "me",
+    "my", "i", "we", "our", "ours", "had", "been", "do", "does", "did",
+    "doing", "am", "all", "any", "more", "most", "other", "some", "such",
+    "no", "nor", "only", "own", "same", "so", "than", "too", "very",
+    "can", "will", "just", "don", "should", "now", "linkedin", "instagram",
+    "facebook", "join", "us"
+}
+
+def connect(db_path: str):
+    """
+        Opens a connection that can share the database with other ingestion processes.
+        WAL lets readers and one writer work at the same time, the busy timeout makes writers wait for each other.
+        Args:
+            db_path (str): The path to the SQLite database file.
+        Returns:
+            sqlite3.Connection: The connection.
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+    conn.execute("PRAGMA journal_mode = WAL")
+    return conn
+
+def begin_write(conn: sqlite3.Connection):
+    """
+        Starts a write transaction, taking the write lock up front.
+        A deferred transaction that upgrades to a write can fail right away in WAL mode,
+        so the lock is taken first and retried with a backoff if the busy timeout runs out.
+        Args:
+            conn (sqlite3.Connection): An open connection.
+        Returns:
+            None
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e) or attempt == WRITE_RETRIES - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+@contextmanager
+def ingestion_lock(db_path: str, exclusive: bool = False):
+    """
+        Held shared by every process adding images, and exclusively by the full index maintenance,
+        which rebuilds the photos table and must not run while another process writes to it.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            exclusive (bool): Take the lock for the maintenance, without waiting for the ingestion.
+        Yields:
+            bool: False if exclusive was asked and images are being added, True otherwise.
+    """
+    with open(f"{db_path}.ingest.lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB if exclusive else fcntl.LOCK_SH)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def fts_options(prefix: tuple = FTS_PREFIX, tokenizer: str = FTS_TOKENIZER):
+    """
+        Returns the FTS5 options for the prefix indexes and the tokenizer.
+        Args:
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
+        Returns:
+            str: The options to put after the columns in CREATE VIRTUAL TABLE.
+    """
+    options = f"tokenize = '{tokenizer}'"
+    if prefix:
+        options = f"prefix = '{' '.join(str(length) for length in prefix)}', " + options
+    return options
+
+def words_of(text: str):
+    """
+        Splits a text into lowercase words, the same way the unicode61 tokenizer does.
+        Args:
+            text (str): The text.
+        Returns:
+            list: The words.
+    """
+    return re.findall(r"[^\W_]+", text.lower())
+
+def create_search_words(cursor: sqlite3.Cursor):
+    """
+        Creates the table of every word in the index, unstemmed, for type-ahead.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+        Returns:
+            None
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_words (
+        word TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+    ''')
+
+def index_words(cursor: sqlite3.Cursor, texts: list):
+    """
+        Adds the words of the texts to the type-ahead word list.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            texts (list): The faces and captions that were added.
+        Returns:
+            None
+    """
+    words = {word for text in texts for word in words_of(text)}
+    cursor.executemany('''
+    INSERT OR IGNORE INTO search_words (word) VALUES (?)
+    ''', [(word,) for word in words])
+
+def prefix_term(word: str, cursor: sqlite3.Cursor = None):
+    """
+        The FTS5 term for a word that is still being typed.
+        Args:
+            word (str): The partial word.
+            cursor (sqlite3.Cursor): A cursor to expand the word with the search_words table.
+        Returns:
+            str: The prefix term, ORed with the complete words it can become.
+    """
+    words = []
+    if cursor is not None:
+        prefix = word.lower()
+        try:
+            words = [row[0] for row in cursor.execute('''
+            SELECT word FROM search_words WHERE word >= ? AND word < ? LIMIT ?
+            ''', (prefix, prefix + "\U0010ffff", PREFIX_EXPANSION))]
+        except sqlite3.OperationalError:
+            # Databases created before the word list existed
+            pass
+    if not words:
+        return f'"{word}"*'
+    return "(" + " OR ".join([f'"{word}"*'] + [f'"{complete}"' for complete in words]) + ")"
+
+def prepare_query(
+        query: str,
+        type_ahead: bool = True,
+        any_word: bool = False,
+        cursor: sqlite3.Cursor = None
+    ):
+    """
+        Turns a typed query into an FTS5 query.
+        Stop words are dropped, every word is quoted so punctuation can't break the query,
+        "faces:alice" and "caption:dog" search a single column, and the last word is matched
+        as a prefix while typing (unless it is a stop word, "dog on the" only searches "dog").
+        Args:
+            query (str): The query as typed by the user.
+            type_ahead (bool): Match the last word as a prefix.
+            any_word (bool): Match images with any of the words instead of all of them.
+            cursor (sqlite3.Cursor): A cursor to expand the prefix with complete words, see PREFIX_EXPANSION.
+        Returns:
+            str: The FTS5 query, empty if no word is left.
+    """
+    words = query.replace('"', ' ').split()
+
+    terms = []
+    for position, word in enumerate(words):
+        # AND / OR / NOT keep working as FTS5 operators
+        if word in ("AND", "OR", "NOT"):
+            if terms and terms[-1] not in ("AND", "OR", "NOT"):
+                terms.append(word)
+            continue
+
+        column, _, term = word.partition(":")
+        if term and column.lower() in FILTER_COLUMNS:
+            column = column.lower() + ":"
+        else:
+            column, term = "", word
+            if term.lower() in STOP_WORDS:
+                continue
+
+        # Punctuation alone has no tokens and would match nothing
+        if not words_of(term):
+            continue
+
+        # While typing, the last word may be the start of a longer word ("do" -> "dog")
+        if type_ahead and position == len(words) - 1:
+            terms.append(column + prefix_term(term, cursor))
+        else:
+            terms.append(f'{column}"{term}"')
+
+    # An operator needs a term on both sides
+    while terms and terms[-1] in ("AND", "OR", "NOT"):
+        terms.pop()
+
+    # FTS5 only allows the implicit AND between plain phrases, not next to an expanded prefix
+    joined = []
+    for term in terms:
+        if joined and joined[-1] not in ("AND", "OR", "NOT") and term not in ("AND", "OR", "NOT"):
+            joined.append("OR" if any_word else "AND")
+        joined.append(term)
+    return " ".join(joined)
+
+def initialize_database(
+        db_path: str,
+        prefix: tuple = FTS_PREFIX,
+        tokenizer: str = FTS_TOKENIZER
+    ):
      """
         Initializes a new SQLite database with a table named "photos"
         The table has three columns: "image_path", "faces", and "caption".
         Args:
             db_path (str): The path to the SQLite database file.
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
         Returns:
             None
     """
      conn = None
      try:
-         conn = sqlite3.connect(db_path)
+         conn = connect(db_path)
          cursor = conn.cursor()
 
          # Create the photos table
-         cursor.execute('''
-         CREATE VIRTUAL TABLE IF NOT EXISTS photos USING fts5(
-             image_path,
-             faces,
-             caption,
-         );
-         ''')
+         create_photos_table(cursor, "photos", prefix, tokenizer)
+
+         # Create the video_frames table (faces and caption of a video at a timestamp)
+         create_video_frames_table(cursor, prefix, tokenizer)
+
+         # Create the rest of the tables
+         ensure_schema(cursor)
          conn.commit()
      except sqlite3.Error as e:
          print(f"An error occurred: {e.args[0]}")
@@ -35,6 +274,159 @@ def initialize_database(db_path: str):
          if conn:
              conn.close()
 
+def create_photos_table(
+        cursor: sqlite3.Cursor,
+        table_name: str = "photos",
+        prefix: tuple = FTS_PREFIX,
+        tokenizer: str = FTS_TOKENIZER
+    ):
+    """
+        Creates the photos FTS5 table.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            table_name (str): The name of the table.
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
+        Returns:
+            None
+    """
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING fts5(
+        image_path,
+        faces,
+        caption,
+        {fts_options(prefix, tokenizer)}
+    );
+    ''')
+
+def create_person_index(cursor: sqlite3.Cursor):
+    """
+        Creates the person -> image posting table and the co-occurrence counts.
+        Images are referenced by the rowid of the photos table.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+        Returns:
+            None
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS person_images (
+        person TEXT NOT NULL,
+        photo_id INTEGER NOT NULL,
+        PRIMARY KEY (person, photo_id)
+    ) WITHOUT ROWID;
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS person_images_by_photo ON person_images (photo_id);
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS person_cooccurrence (
+        person_a TEXT NOT NULL,
+        person_b TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (person_a, person_b)
+    ) WITHOUT ROWID;
+    ''')
+
+def index_people(cursor: sqlite3.Cursor, photo_id: int, faces: list):
+    """
+        Adds the people of an image to the person index and the co-occurrence counts.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            photo_id (int): The rowid of the image in the photos table.
+            faces (list): The faces in the image.
+        Returns:
+            None
+    """
+    people = sorted({person_key(face) for face in faces} - {"unknown"})
+    cursor.executemany('''
+    INSERT OR IGNORE INTO person_images (person, photo_id) VALUES (?, ?)
+    ''', [(person, photo_id) for person in people])
+
+    # Both directions are stored so "who appears with X" is a single range scan
+    cursor.executemany('''
+    INSERT INTO person_cooccurrence (person_a, person_b, count) VALUES (?, ?, 1)
+    ON CONFLICT(person_a, person_b) DO UPDATE SET count = count + 1
+    ''', [(a, b) for a in people for b in people if a != b])
+
+def unindex_people(cursor: sqlite3.Cursor, photo_id: int, faces: list):
+    """
+        Removes the people of an image from the person index and the co-occurrence counts.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            photo_id (int): The rowid of the image in the photos table.
+            faces (list): The faces that were indexed for the image.
+        Returns:
+            None
+    """
+    people = sorted({person_key(face) for face in faces} - {"unknown"})
+    cursor.execute('''
+    DELETE FROM person_images WHERE photo_id = ?
+    ''', (photo_id,))
+    cursor.executemany('''
+    UPDATE person_cooccurrence SET count = count - 1 WHERE person_a = ? AND person_b = ?
+    ''', [(a, b) for a in people for b in people if a != b])
+    cursor.execute('''
+    DELETE FROM person_cooccurrence WHERE count <= 0
+    ''')
+
+def ensure_schema(cursor: sqlite3.Cursor):
+    """
+        Creates the tables added after the first version (face_names, video_frames, the person index
+        and the type-ahead word list) and fills them for older databases. Safe to call on every write.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection, inside a write transaction.
+        Returns:
+            None
+    """
+    create_photos_table(cursor)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS face_names (
+        face_id TEXT PRIMARY KEY,
+        face_name TEXT NOT NULL
+    );
+    ''')
+    create_video_frames_table(cursor)
+    create_person_index(cursor)
+    create_search_words(cursor)
+
+    # The version marker says what was built, an empty table doesn't
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    if version < 3:
+        cursor.execute("DELETE FROM person_images")
+        cursor.execute("DELETE FROM person_cooccurrence")
+        for photo_id, faces in cursor.execute("SELECT rowid, faces FROM photos").fetchall():
+            index_people(cursor, photo_id, faces.split())
+    if version < 2:
+        for table in ("photos", "video_frames"):
+            index_words(cursor, [text for row in cursor.execute(f"SELECT faces, caption FROM {table}") for text in row])
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def rebuild_person_index(db_path: str):
+    """
+        Builds the person index from the faces column, for databases created before it existed.
+        Does nothing if the index was already built.
+        Args:
+            db_path (str): The path to the SQLite database file.
+        Returns:
+            None
+    """
+    conn = None
+    try:
+        conn = connect(db_path)
+        # Reading the version marker takes no lock, searches only wait for ingestion on an old database
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        begin_write(conn)
+        ensure_schema(conn.cursor())
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+
 def add_image(
         image_path: str,
         faces: list,
@@ -49,13 +441,21 @@ def add_image(
             caption (str): A caption for the image.
             db_path (str): The path to the SQLite database file.
         Returns:
-            None
+            int: The rowid of the image in the photos table, None if it wasn't added.
     """
     conn = None
+    photo_id = None
     try:
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
+        begin_write(conn)
         cursor = conn.cursor()
 
+        # Databases created before the person index and video frames need the new tables
+        ensure_schema(cursor)
+
+        # Use the name of the face if it was already named
+        faces = resolve_face_names(cursor, faces)
+
         # Convert the list of faces to string
         faces_str = ' '.join(faces)
 
@@ -64,7 +464,13 @@ def add_image(
             cursor.execute('''
             INSERT INTO photos (image_path, faces, caption) VALUES (?, ?, ?)
             ''', (image_path, faces_str, caption))
+            rowid = cursor.lastrowid
+            index_people(cursor, rowid, faces)
+            index_words(cursor, [faces_str, caption])
             conn.commit()
+
+            # Only an image that was committed has a rowid
+            photo_id = rowid
         except sqlite3.IntegrityError:
             console.print(f"Image at '{image_path}' already exists in the database.", style="bold red")
     except sqlite3.Error as e:
@@ -72,30 +478,226 @@ def add_image(
     finally:
         if conn:
             conn.close()
+    return photo_id
 
-def search_images(
+def create_video_frames_table(
+        cursor: sqlite3.Cursor,
+        prefix: tuple = FTS_PREFIX,
+        tokenizer: str = FTS_TOKENIZER
+    ):
+    """
+        Creates the video_frames table, one row per sampled frame of a video.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
+        Returns:
+            None
+    """
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS video_frames USING fts5(
+        video_path,
+        timestamp UNINDEXED,
+        faces,
+        caption,
+        {fts_options(prefix, tokenizer)}
+    );
+    ''')
+
+def add_video_frames(
+        video_path: str,
+        frames: list,
+        db_path: str
+    ):
+    """
+        Adds the faces and captions of sampled video frames to the database.
+        Args:
+            video_path (str): The path to the video file.
+            frames (list): A list of (timestamp in seconds, faces, caption) tuples.
+            db_path (str): The path to the SQLite database file.
+        Returns:
+            None
+    """
+    conn = None
+    try:
+        conn = connect(db_path)
+        begin_write(conn)
+        cursor = conn.cursor()
+        ensure_schema(cursor)
+
+        rows = []
+        for timestamp, faces, caption in frames:
+            faces = resolve_face_names(cursor, faces)
+            rows.append((video_path, timestamp, ' '.join(faces), caption))
+        cursor.executemany('''
+        INSERT INTO video_frames (video_path, timestamp, faces, caption) VALUES (?, ?, ?, ?)
+        ''', rows)
+        index_words(cursor, [text for _, _, faces, caption in rows for text in (faces, caption)])
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+
+def search_video_frames(
         query: str,
         db_path: str
     ):
+    """
+        Searches the video frames that match the query.
+        Args:
+            query (str): The search query.
+            db_path (str): The path to the SQLite database file.
+        Returns:
+            list: A list of tuples containing the video_path, timestamp, faces, and caption of the matching frames.
+    """
+    conn = None
+    results = []
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+
+        # Databases created before videos were supported
+        if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'video_frames'").fetchone():
+            return results
+        query = prepare_query(query, cursor=cursor)
+        if not query:
+            return results
+
+        cursor.execute('''
+        SELECT video_path, timestamp, faces, caption
+        FROM video_frames
+        WHERE video_frames MATCH ?
+        ORDER BY video_path, timestamp
+        ''', (query,))
+        results = cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+def merge_index(db_path: str, pages: int = 500):
+    """
+        Merges some of the FTS5 index segments, cheap enough to run while images are being added.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            pages (int): Roughly how much work the merge does.
+        Returns:
+            None
+    """
+    conn = None
+    try:
+        conn = connect(db_path)
+        begin_write(conn)
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO photos(photos, rank) VALUES('merge', ?)", (pages,))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+
+def rebuild_search_index(
+        cursor: sqlite3.Cursor,
+        prefix: tuple = FTS_PREFIX,
+        tokenizer: str = FTS_TOKENIZER
+    ):
+    """
+        Recreates the photos table with the given prefix indexes and tokenizer.
+        Rowids are kept, the person index points to them.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
+        Returns:
+            None
+    """
+    cursor.execute("DROP TABLE IF EXISTS photos_rebuild")
+    create_photos_table(cursor, "photos_rebuild", prefix, tokenizer)
+    cursor.execute('''
+    INSERT INTO photos_rebuild (rowid, image_path, faces, caption)
+    SELECT rowid, image_path, faces, caption FROM photos
+    ''')
+    cursor.execute("DROP TABLE photos")
+    cursor.execute("ALTER TABLE photos_rebuild RENAME TO photos")
+
+def optimize_database(
+        db_path: str,
+        prefix: tuple = FTS_PREFIX,
+        tokenizer: str = FTS_TOKENIZER,
+        vacuum: bool = True
+    ):
+    """
+        Index maintenance: upgrades the photos table to the configured prefix indexes and tokenizer,
+        merges all FTS5 segments, refreshes the query planner statistics and vacuums the file.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            prefix (tuple): The prefix lengths to index.
+            tokenizer (str): The FTS5 tokenizer.
+            vacuum (bool): Rewrite the database file to reclaim the free pages.
+        Returns:
+            None
+    """
+    conn = None
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+
+        # Databases created with other FTS5 options are rebuilt once
+        row = cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'photos'").fetchone()
+        if row and fts_options(prefix, tokenizer) not in row[0]:
+            rebuild_search_index(cursor, prefix, tokenizer)
+
+        # Merge every segment of the FTS5 tables into one
+        cursor.execute("INSERT INTO photos(photos) VALUES('optimize')")
+        if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'video_frames'").fetchone():
+            cursor.execute("INSERT INTO video_frames(video_frames) VALUES('optimize')")
+
+        cursor.execute("ANALYZE")
+        conn.commit()
+
+        # VACUUM can't run inside a transaction
+        if vacuum:
+            cursor.execute("VACUUM")
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+
+def search_images(
+        query: str,
+        db_path: str,
+        with_rank: bool = False
+    ):
     """
         Searches the database for images that match the query.
         Args:
             query (str): The search query.
             db_path (str): The path to the SQLite database file.
+            with_rank (bool): Also return the bm25 rank (lower is better) of every image.
         Returns:
             list: A list of tuples containing the image_path, faces, and caption of the matching images.
     """
     conn = None
     results = []
     try:
-        conn = sqlite3.connect(db_path)
+        conn = connect(db_path)
         cursor = conn.cursor()
+        query = prepare_query(query, cursor=cursor)
+        if not query:
+            return results
 
         # Using FTS5 to search the database
-        cursor.execute('''
-        SELECT image_path, faces, caption
+        cursor.execute(f'''
+        SELECT image_path, faces, caption{", rank" if with_rank else ""}
         FROM photos
         WHERE photos MATCH ?
+        ORDER BY rank
         ''', (query,))
 
         results = cursor.fetchall()
@@ -106,6 +708,266 @@ def search_images(
             conn.close()
     return results
 
+def search_image_ids(
+        query: str,
+        db_path: str,
+        limit: int = 200,
+        candidates: int = BM25_CANDIDATES
+    ):
+    """
+        Searches the database for images with any of the words of the query, best bm25 rank first.
+        Only the first candidates matches of a query are ranked: the images with all the words first,
+        the images with any of them fill up the rest.
+        Args:
+            query (str): The search query.
+            db_path (str): The path to the SQLite database file.
+            limit (int): The maximum number of images.
+            candidates (int): The maximum number of matches ranked for every query.
+        Returns:
+            list: A list of (rowid, rank) tuples, the rank is negative and lower is better.
+    """
+    conn = None
+    results = []
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+        ranks = {}
+        fts_queries = dict.fromkeys(prepare_query(query, any_word=any_word, cursor=cursor) for any_word in (False, True))
+        for fts_query in fts_queries:
+            if not fts_query:
+                break
+
+            # The rank of a row is only computed when it is read, the LIMIT keeps a
+            # common word from ranking most of the library
+            ranks.update(cursor.execute('''
+            SELECT rowid, rank
+            FROM (SELECT rowid, rank FROM photos WHERE photos MATCH ? LIMIT ?)
+            ORDER BY rank
+            LIMIT ?
+            ''', (fts_query, candidates, limit)).fetchall())
+            if len(ranks) >= limit:
+                break
+        results = sorted(ranks.items(), key=lambda item: item[1])[:limit]
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+def get_images(db_path: str, photo_ids: list):
+    """
+        Returns the images with the given rowids.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            photo_ids (list): The rowids of the images in the photos table.
+        Returns:
+            dict: A mapping of rowid -> (image_path, faces, caption).
+    """
+    conn = None
+    images = {}
+    if not photo_ids:
+        return images
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" * len(photo_ids))
+        cursor.execute(f'''
+        SELECT rowid, image_path, faces, caption
+        FROM photos
+        WHERE rowid IN ({placeholders})
+        ''', [int(photo_id) for photo_id in photo_ids])
+        images = {row[0]: row[1:] for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return images
+
+def search_people(
+        db_path: str,
+        include: list,
+        exclude: list = None
+    ):
+    """
+        Searches the person index for images with all the people in include and none in exclude.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            include (list): The people that must be in the image.
+            exclude (list): The people that must not be in the image.
+        Returns:
+            list: A list of tuples containing the image_path, faces, and caption of the matching images.
+    """
+    conn = None
+    results = []
+    exclude = exclude or []
+    if not include:
+        return results
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+
+        # Intersect the posting lists of the included people and subtract the excluded ones
+        posting = "SELECT photo_id FROM person_images WHERE person = ?"
+        photo_ids = " INTERSECT ".join([posting] * len(include))
+        if exclude:
+            photo_ids += " EXCEPT " + " EXCEPT ".join([posting] * len(exclude))
+
+        cursor.execute(f'''
+        SELECT image_path, faces, caption
+        FROM photos
+        WHERE rowid IN ({photo_ids})
+        ''', [person_key(person) for person in list(include) + list(exclude)])
+        results = cursor.fetchall()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+def images_of_people(
+        db_path: str,
+        people: list
+    ):
+    """
+        Returns the images of each of the given people.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            people (list): The people to look for.
+        Returns:
+            list: A list of tuples containing the person, image_path, faces, and caption.
+    """
+    conn = None
+    results = []
+    if not people:
+        return results
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+        # The index is keyed by person_key, the results use the people as they were given
+        people = {person_key(person): person for person in reversed(list(people))}
+        placeholders = ", ".join("?" * len(people))
+        cursor.execute(f'''
+        SELECT person_images.person, photos.image_path, photos.faces, photos.caption
+        FROM person_images
+        JOIN photos ON photos.rowid = person_images.photo_id
+        WHERE person_images.person IN ({placeholders})
+        ''', list(people))
+        results = [(people[key], image_path, faces, caption) for key, image_path, faces, caption in cursor.fetchall()]
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+def co_occurring_people(
+        db_path: str,
+        person: str,
+        limit: int = 10
+    ):
+    """
+        Returns the people who appear most often in the same images as person.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            person (str): The person to look for.
+            limit (int): The maximum number of people to return, None for all of them.
+        Returns:
+            list: A list of (person, number of shared images) tuples.
+    """
+    conn = None
+    results = []
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+        # A negative LIMIT returns every row
+        rows = cursor.execute('''
+        SELECT person_b, count
+        FROM person_cooccurrence
+        WHERE person_a = ?
+        ORDER BY count DESC
+        LIMIT ?
+        ''', (person_key(person), -1 if limit is None else limit)).fetchall()
+
+        # The index is keyed by person_key, the results show the names as they were typed
+        names = {person_key(face_name): face_name for (face_name,) in cursor.execute('''
+        SELECT face_name FROM face_names
+        ''').fetchall()}
+        results = [(names.get(key, key), count) for key, count in rows]
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+    return results
+
+def resolve_face_names(cursor: sqlite3.Cursor, faces: list):
+    """
+        Replaces the face_ids that were already named with their names.
+        Args:
+            cursor (sqlite3.Cursor): A cursor of an open connection.
+            faces (list): A list of face_ids.
+        Returns:
+            list: The faces with the known face_ids replaced by names.
+    """
+    try:
+        resolved = []
+        for face in faces:
+            row = cursor.execute('''
+            SELECT face_name FROM face_names WHERE face_id = ?
+            ''', (face,)).fetchone()
+            resolved.append(row[0] if row else face)
+        return resolved
+    except sqlite3.OperationalError:
+        # Databases created before face_names existed
+        return faces
+
+def get_face_names(db_path: str):
+    """
+        Returns all the face_ids that were named.
+        Args:
+            db_path (str): The path to the SQLite database file.
+        Returns:
+            dict: A mapping of face_id -> face_name.
+    """
+    conn = None
+    face_names = {}
+    try:
+        conn = connect(db_path)
+        cursor = conn.cursor()
+        face_names = dict(cursor.execute('''
+        SELECT face_id, face_name FROM face_names
+        ''').fetchall())
+    except sqlite3.Error:
+        # Databases created before face_names existed
+        pass
+    finally:
+        if conn:
+            conn.close()
+    return face_names
+
+def normalize_face_name(face_name: str):
+    """
+        Makes a name safe for the space separated faces column, "Alice Smith" becomes "Alice_Smith".
+        Args:
+            face_name (str): The name as typed by the user.
+        Returns:
+            str: The name without whitespace.
+    """
+    return "_".join(face_name.split())
+
+def person_key(face_name: str):
+    """
+        The key of a person in the person index, so "alice smith" finds the images of "Alice_Smith".
+        Args:
+            face_name (str): A name or face_id, as stored or as typed.
+        Returns:
+            str: The name without whitespace and case.
+    """
+    return normalize_face_name(face_name).casefold()
+
 def name_faces(db_path: str, face_id: str, face_name: str):
      """
           Changes the face_id to face_name in the database.
@@ -116,42 +978,97 @@ def name_faces(db_path: str, face_id: str, face_name: str):
           Returns:
                None
      """
-     conn = None
-     try:
-          conn = sqlite3.connect(db_path)
-          cursor = conn.cursor()
+     name_faces_bulk(db_path=db_path, face_names={face_id: face_name})
 
-                    # Retrieve the rows that need to be updated
-          cursor.execute('''
-          SELECT image_path, faces, caption
-          FROM photos
-          WHERE faces LIKE ?
-          ''', ("%"+face_id+"%",))
+def name_faces_bulk(db_path: str, face_names: dict):
+    """
+        Changes many face_ids to their face_names in one transaction.
+        A face that already had a name is renamed too, the old name is replaced everywhere.
+        Args:
+            db_path (str): The path to the SQLite database file.
+            face_names (dict): A mapping of face_id -> face_name.
+        Returns:
+            int: The number of rows (photos and video frames) that were updated, None if it failed.
+    """
+    conn = None
+    updated = 0
+    face_names = {face_id: normalize_face_name(face_name) for face_id, face_name in face_names.items()}
+    try:
+        conn = connect(db_path)
+        begin_write(conn)
+        cursor = conn.cursor()
+        ensure_schema(cursor)
 
-          rows = cursor.fetchall()
+        # The rows hold the face_id if the face was never named and the old name otherwise
+        stored = dict(cursor.execute('''
+        SELECT face_id, face_name FROM face_names
+        ''').fetchall())
+        replace = dict(face_names)
+        for face_id, face_name in list(face_names.items()):
+            old_name = stored.get(face_id)
+            if not old_name or old_name == face_name or old_name in replace:
+                continue
+            replace[old_name] = face_name
+            # The rows can't tell apart the faces that shared the old name, so they are all renamed
+            for other_id, other_name in stored.items():
+                if other_name == old_name and other_id not in face_names:
+                    face_names[other_id] = face_name
 
-          # Update the faces column for each row
-          for row in rows:
-              image_path, faces, caption = row
-              new_faces = faces.replace(face_id, face_name)
+        # Remember the names so images added later get the name directly
+        cursor.executemany('''
+        INSERT INTO face_names (face_id, face_name) VALUES (?, ?)
+        ON CONFLICT(face_id) DO UPDATE SET face_name = excluded.face_name
+        ''', list(face_names.items()))
+        index_words(cursor, face_names.values())
 
-              # Update the row
-              cursor.execute('''
-              DELETE FROM photos
-              WHERE image_path = ? AND faces = ?
-              ''', (image_path, faces))
+        # Only the images of the renamed people are read, found through the person index
+        tokens = list(replace)
+        photo_ids = set()
+        for start in range(0, len(tokens), 500):
+            chunk = tokens[start:start + 500]
+            photo_ids.update(photo_id for (photo_id,) in cursor.execute(f'''
+            SELECT photo_id FROM person_images WHERE person IN ({", ".join("?" * len(chunk))})
+            ''', [person_key(token) for token in chunk]))
+        for photo_id in sorted(photo_ids):
+            row = cursor.execute('''
+            SELECT faces FROM photos WHERE rowid = ?
+            ''', (photo_id,)).fetchone()
+            if row is None:
+                continue
+            old_faces = row[0].split()
+            new_faces = [replace.get(face, face) for face in old_faces]
+            if new_faces != old_faces:
+                cursor.execute('''
+                UPDATE photos SET faces = ? WHERE rowid = ?
+                ''', (' '.join(new_faces), photo_id))
+                unindex_people(cursor, photo_id, old_faces)
+                index_people(cursor, photo_id, new_faces)
+                updated += 1
 
-              cursor.execute('''
-              INSERT INTO photos (image_path, faces, caption)
-              VALUES (?, ?, ?)
-              ''', (image_path, new_faces, caption))
+        # The video frames have no person index, the full-text index narrows them down instead
+        frames = {}
+        for token in tokens:
+            phrase = token.replace('"', '""')
+            frames.update(cursor.execute('''
+            SELECT rowid, faces FROM video_frames WHERE video_frames MATCH ?
+            ''', (f'faces:"{phrase}"',)).fetchall())
+        for rowid, faces in sorted(frames.items()):
+            old_faces = faces.split()
+            new_faces = [replace.get(face, face) for face in old_faces]
+            if new_faces != old_faces:
+                cursor.execute('''
+                UPDATE video_frames SET faces = ? WHERE rowid = ?
+                ''', (' '.join(new_faces), rowid))
+                updated += 1
 
-          conn.commit()
-     except sqlite3.Error as e:
-          print(f"An error occurred: {e.args[0]}")
-     finally:
-          if conn:
-               conn.close()
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+        updated = None
+    finally:
+        if conn:
+            conn.close()
+    return updated
 
 def show_all_at_once(db_path: str):
      """
@@ -163,7 +1080,7 @@ def show_all_at_once(db_path: str):
      """
      conn = None
      try:
-          conn = sqlite3.connect(db_path)
+          conn = connect(db_path)
           cursor = conn.cursor()
 
           # Retrieve all the rows
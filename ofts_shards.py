@@ -0,0 +1,190 @@
+# Import the built-in libraries
+import os
+import sqlite3
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Import the external libraries
+from rich.console import Console
+
+# Import the local files
+import ofts_database as ofts_db
+
+# Every library root is a shard with its own database and KNOWN_EMBEDDINGS
+# The catalog keeps track of all the shards, detached shards keep their files
+home = Path.home()
+CATALOG_PATH = f"{home}/.ofts/catalog.db"
+SHARDS_DIR = f"{home}/.ofts/shards"
+
+# The library from before shards existed
+DEFAULT_SHARD = "default"
+
+# console object
+console = Console()
+
+def initialize_catalog():
+    """
+        Creates the catalog and registers the default library in it
+        Args:
+            None
+        Returns:
+            None
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(CATALOG_PATH)
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shards (
+            name TEXT PRIMARY KEY,
+            root TEXT NOT NULL,
+            db_path TEXT NOT NULL,
+            embeddings_dir TEXT NOT NULL,
+            attached INTEGER NOT NULL DEFAULT 1
+        );
+        ''')
+
+        # The default library is the directory chosen during the first image tagging
+        root = ""
+        if os.path.exists(f"{home}/.ofts/init_ofts.db"):
+            init_conn = sqlite3.connect(f"{home}/.ofts/init_ofts.db")
+            row = init_conn.execute("SELECT directory FROM init_data").fetchone()
+            init_conn.close()
+            root = row[0] if row else ""
+        cursor.execute('''
+        INSERT OR IGNORE INTO shards (name, root, db_path, embeddings_dir) VALUES (?, ?, ?, ?)
+        ''', (DEFAULT_SHARD, root, f"{home}/.ofts/ofts.db", f"{home}/.ofts/KNOWN_EMBEDDINGS"))
+
+        # The catalog may have been created before the first image tagging chose the directory
+        cursor.execute('''
+        UPDATE shards SET root = ? WHERE name = ? AND root = ''
+        ''', (root, DEFAULT_SHARD))
+        conn.commit()
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e.args[0]}")
+    finally:
+        if conn:
+            conn.close()
+
+def add_shard(name: str, root: str):
+    """
+        Creates a new empty shard for a library root
+        Args:
+            name (str): the name of the shard
+            root (str): the library root directory
+        Returns:
+            dict: the shard
+    """
+    shard_dir = os.path.join(SHARDS_DIR, name)
+    os.makedirs(os.path.join(shard_dir, "KNOWN_EMBEDDINGS"), exist_ok=True)
+    ofts_db.initialize_database(db_path=os.path.join(shard_dir, "ofts.db"))
+    return attach_shard(name, shard_dir, root)
+
+def attach_shard(name: str, shard_dir: str = None, root: str = None):
+    """
+        Registers an existing shard directory (with ofts.db and KNOWN_EMBEDDINGS) in the catalog,
+        or attaches a detached shard again. Nothing is reindexed.
+        Args:
+            name (str): the name of the shard
+            shard_dir (str): the directory of the shard, not needed for a known shard
+            root (str): the library root directory
+        Returns:
+            dict: the shard
+    """
+    initialize_catalog()
+    conn = sqlite3.connect(CATALOG_PATH)
+    try:
+        if shard_dir is None:
+            conn.execute("UPDATE shards SET attached = 1 WHERE name = ?", (name,))
+        else:
+            conn.execute('''
+            INSERT INTO shards (name, root, db_path, embeddings_dir, attached) VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT(name) DO UPDATE SET
+                root = excluded.root, db_path = excluded.db_path,
+                embeddings_dir = excluded.embeddings_dir, attached = 1
+            ''', (name, root or "", os.path.join(shard_dir, "ofts.db"), os.path.join(shard_dir, "KNOWN_EMBEDDINGS")))
+        conn.commit()
+    finally:
+        conn.close()
+    return get_shard(name)
+
+def detach_shard(name: str):
+    """
+        Leaves a shard out of searches, its files are kept so it can be attached again
+        Args:
+            name (str): the name of the shard
+        Returns:
+            None
+    """
+    initialize_catalog()
+    conn = sqlite3.connect(CATALOG_PATH)
+    try:
+        conn.execute("UPDATE shards SET attached = 0 WHERE name = ?", (name,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def list_shards(attached_only: bool = True):
+    """
+        List the shards in the catalog
+        Args:
+            attached_only (bool): leave out the detached shards
+        Returns:
+            list: a list of shards (dicts with name, root, db_path, embeddings_dir and attached)
+    """
+    # Only read, the catalog is created once (by the CLI or the first add/attach/detach)
+    if not os.path.exists(CATALOG_PATH):
+        initialize_catalog()
+    conn = sqlite3.connect(CATALOG_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT * FROM shards" + (" WHERE attached = 1" if attached_only else "") + " ORDER BY name"
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def get_shard(name: str):
+    """
+        Get a shard by name
+        Args:
+            name (str): the name of the shard
+        Returns:
+            dict: the shard, None if there is no such shard
+    """
+    for shard in list_shards(attached_only=False):
+        if shard["name"] == name:
+            return shard
+    return None
+
+def fan_out(search, shards: list = None):
+    """
+        Run a search on every attached shard in parallel threads
+        Args:
+            search (function): takes the db_path of a shard and returns a list of results
+            shards (list): the shards to search, all the attached shards by default
+        Returns:
+            list: the results of all the shards, in shard order
+    """
+    shards = [shard for shard in shards or list_shards() if os.path.exists(shard["db_path"])]
+    if not shards:
+        return []
+
+    # sqlite3 releases the GIL while it runs a query, so threads are enough
+    with ThreadPoolExecutor(max_workers=min(8, len(shards))) as executor:
+        results = executor.map(lambda shard: search(shard["db_path"]) or [], shards)
+        return [result for shard_results in results for result in shard_results]
+
+def search_all_shards(query: str, shards: list = None):
+    """
+        Search every attached shard and merge the results by bm25 rank
+        Args:
+            query (str): the text to search
+            shards (list): the shards to search, all the attached shards by default
+        Returns:
+            list: a list of (image_path, faces, caption) tuples, best first
+    """
+    results = fan_out(lambda db_path: ofts_db.search_images(query, db_path, with_rank=True), shards)
+    results.sort(key=lambda result: result[3])
+    return [(image_path, faces, caption) for image_path, faces, caption, rank in results]
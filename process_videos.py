@@ -0,0 +1,159 @@
+# Import the built-in libraries
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+# Import the external libraries
+import cv2
+import numpy as np
+from PIL import Image
+from rich.console import Console
+
+# Import the local files
+from recognize_faces import rec_face_array
+from caption_images import tag_images_GIT
+from memory_budget import MemoryBudget, is_out_of_memory
+import ofts_database as ofts_db
+
+# Gaps between checked frames of at least this many frames are seeked over instead of grabbed,
+# below that decoding the skipped frames is cheaper than seeking back to a keyframe
+SEEK_FRAMES = 48
+
+# console object
+console = Console()
+
+def frame_signature(frame: np.ndarray):
+    """
+        A tiny grayscale thumbnail of the frame, cheap enough to compute for every checked frame
+        Args:
+            frame (np.ndarray): the BGR frame
+        Returns:
+            np.ndarray: a 16x16 float32 thumbnail
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (16, 16), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def sample_keyframes(
+        video_path: str,
+        interval: float = 2.0,
+        check_every: float = 0.5,
+        scene_threshold: float = 30.0,
+        duplicate_threshold: float = 4.0
+    ):
+    """
+        Stream the frames worth running inference on, one at a time
+        A frame is picked on a scene change, or every interval seconds unless it looks
+        the same as the last picked frame.
+        Args:
+            video_path (str): the path to the video
+            interval (float): seconds between frames picked without a scene change
+            check_every (float): seconds between the frames that are decoded and checked
+            scene_threshold (float): mean pixel difference that counts as a scene change
+            duplicate_threshold (float): mean pixel difference below which a frame is a duplicate
+        Yields:
+            tuple: the timestamp in seconds and the BGR frame
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        step = max(1, int(round(fps * check_every)))
+        last_signature, last_timestamp = None, None
+        frame_index = 0
+
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+
+            timestamp = frame_index / fps
+            signature = frame_signature(frame)
+            if last_signature is None:
+                picked = True
+            else:
+                difference = float(np.mean(np.abs(signature - last_signature)))
+                picked = difference >= scene_threshold or (
+                    timestamp - last_timestamp >= interval and difference >= duplicate_threshold
+                )
+
+            if picked:
+                last_signature, last_timestamp = signature, timestamp
+                yield timestamp, frame
+
+            # grab() still decodes the skipped frames (it only skips the conversion), so long
+            # gaps seek to the next checked frame instead, which decodes from the nearest keyframe
+            frame_index += step
+            if step >= SEEK_FRAMES:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            else:
+                for _ in range(step - 1):
+                    if not capture.grab():
+                        break
+    finally:
+        capture.release()
+
+def batched(frames, batch_size: int):
+    """
+        Group the streamed frames into lists of at most batch_size frames
+        Args:
+            frames (iterable): the frames
+            batch_size (int): the size of a batch
+        Yields:
+            list: a batch of frames
+    """
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def process_video(
+        video_path: str,
+        model_name: str,
+        distance_metric: str,
+        threshold: float,
+        db_path: str,
+        batch_size: int = 8,
+        budget: MemoryBudget = None
+    ):
+    """
+        Run the keyframes of a video through face recognition and captioning and store them
+        Only batch_size frames are held in memory, however long the video is.
+        Args:
+            video_path (str): the path to the video
+            model_name (str): the name of the model for DeepFace
+            distance_metric (str): the distance metric
+            threshold (float): the threshold value
+            db_path (str): the path to the SQLite database file
+            batch_size (int): the number of frames sent to the models at once
+            budget (MemoryBudget): the memory budget of the ingestion, shrunk when a batch runs out of memory
+        Returns:
+            int: the number of frames stored
+    """
+    console.print(f"[bold blue]VIDEO:[/bold blue] {video_path}", style="")
+    stored = 0
+    for batch in batched(sample_keyframes(video_path), batch_size):
+        # A batch the models can't handle only loses its own frames
+        try:
+            faces = [rec_face_array(frame, model_name, distance_metric, threshold) for _, frame in batch]
+            captions = tag_images_GIT([Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)) for _, frame in batch])
+        except Exception as e:
+            if is_out_of_memory(e):
+                if budget is not None:
+                    budget.shrink()
+                console.print(f"Not enough memory for {len(batch)} frames of {video_path}, skipping them.", style="bold red")
+            else:
+                console.print(f"Could not process {len(batch)} frames of {video_path}, skipping them: {e}", style="bold red")
+            continue
+
+        # Remove all special characters and lowercase everything
+        captions = [''.join(e for e in caption if e.isalnum() or e.isspace()).lower() for caption in captions]
+
+        ofts_db.add_video_frames(
+            video_path,
+            [(timestamp, frame_faces, caption) for (timestamp, _), frame_faces, caption in zip(batch, faces, captions)],
+            db_path=db_path,
+        )
+        stored += len(batch)
+    return stored
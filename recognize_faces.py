@@ -1,16 +1,20 @@
 # import the built-in libraries
-import os, uuid
+import os, uuid, shutil
+import fcntl
+from contextlib import contextmanager
 import warnings
 from pathlib import Path
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 # import the external libraries
 from deepface import DeepFace
-from deepface.modules.verification import find_distance
 import cv2
 import numpy as np
 from rich.console import Console
 
+# Import the local files
+from memory_budget import read_image, DECODE_PIXELS
+
 # Look here for more information: https://github.com/serengil/deepface/
 
 # Disable warnings
@@ -24,6 +28,19 @@ if not os.path.exists(f"{home}/.ofts/KNOWN_EMBEDDINGS"):
     os.makedirs(f"{home}/.ofts/KNOWN_EMBEDDINGS")
 known_embedding_folder = f"{home}/.ofts/KNOWN_EMBEDDINGS"
 
+# Stacked copy of all the known embeddings, rebuilt when KNOWN_EMBEDDINGS changes
+embedding_index_path = f"{home}/.ofts/embedding_index.npz"
+
+# KNOWN_EMBEDDINGS of other libraries, also checked when matching a face
+shared_embedding_folders = []
+
+# Embedding indexes loaded by this process, keyed by the path of the index file
+_INDEX_CACHE = {}
+
+# The index file is rewritten once a rebuild had to load this many new embeddings,
+# smaller changes (a face added during ingestion) are only kept in memory
+INDEX_SAVE_MIN = 64
+
 # console object
 console = Console()
 
@@ -38,6 +55,39 @@ def create_directory_if_not_exists(directory: str):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+def use_known_embedding_folder(folder: str, shared_folders: list = None):
+    """
+        Switch to the KNOWN_EMBEDDINGS directory of another library
+        Args:
+            folder (str): the KNOWN_EMBEDDINGS directory of the library
+            shared_folders (list): KNOWN_EMBEDDINGS of other libraries to match faces against
+        Returns:
+            None
+    """
+    global known_embedding_folder, embedding_index_path, shared_embedding_folders
+    create_directory_if_not_exists(folder)
+    known_embedding_folder = folder
+    embedding_index_path = os.path.join(os.path.dirname(folder), "embedding_index.npz")
+    shared_embedding_folders = [shared for shared in shared_folders or [] if shared != folder]
+
+@contextmanager
+def identity_lock():
+    """
+        Serialize identity assignment between ingestion processes sharing a library
+        Without it two processes can both miss a new face and give it two unique ids.
+        Args:
+            None
+        Yields:
+            None
+    """
+    lock_path = os.path.join(os.path.dirname(known_embedding_folder), "identity.lock")
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 def check_if_known_embedding(
         given_embedding: np.array,
         distance_metric: str,
@@ -57,30 +107,22 @@ def check_if_known_embedding(
     min_distance = float('inf')
     closest_match = False
 
-    # loop through all the known embeddings
-    for known_embedding_dir in os.listdir(known_embedding_folder):
-
-        # The whole below code loops through known_embedding directory and checks if the given embedding is known
-        # If the given embedding is known, it returns the embedding directory name where all the similar embeddings are stored
-        # else it returns False
-
-        # Example: All elon musk embeddings are stored in one directory and all biden embeddings are stored in another directory
-        # so that we can loop through all different embeddings of same person and check if the given embedding is known
-        # Personally, This improved my accuracy a lot than simply checking against one embedding
-        known_embedding_dir_path = os.path.join(known_embedding_folder, known_embedding_dir)
-        if os.path.isdir(known_embedding_dir_path):
-            for known_embedding in os.listdir(known_embedding_dir_path):
-                if known_embedding.endswith(".npy"):
-                    known_embedding = np.load(os.path.join(known_embedding_dir_path, known_embedding))
+    # Every identity directory keeps all the embeddings of one person
+    # Example: All elon musk embeddings are stored in one directory and all biden embeddings are stored in another directory
+    # so that we can check against all different embeddings of same person
+    # Personally, This improved my accuracy a lot than simply checking against one embedding
+    # (this library first, then the shared ones)
+    for embedding_folder in [known_embedding_folder] + shared_embedding_folders:
+        embeddings, identities = load_embedding_index(embedding_folder)
+        if len(embeddings) == 0:
+            continue
 
-                    # Use the find_distance function from deepface to find the distance between the embeddings
-                    result = find_distance(known_embedding, given_embedding, distance_metric=distance_metric)
-                    #print(f"Comparing with {known_embedding_dir}: distance = {result}")
-
-                    # If the distance is less than the minimum distance till now, update the minimum distance and the closest match
-                    if result < min_distance:
-                        min_distance = result
-                        closest_match = known_embedding_dir
+        # The distance to every known embedding of the library in one numpy call
+        distances = find_distances(embeddings, given_embedding, distance_metric)
+        closest = int(np.argmin(distances))
+        if distances[closest] < min_distance:
+            min_distance = float(distances[closest])
+            closest_match = str(identities[closest])
 
     # finally, If the minimum distance is less than the threshold, return the closest match
 
@@ -92,28 +134,235 @@ def check_if_known_embedding(
 def get_unique_id(
         given_embedding: np.array,
         distance_metric: str,
-        threshold: float
+        threshold: float,
+        match = None
     ):
     """
-        Get the unique id for the given embedding
+        Get the unique id for the given embedding, call it while holding identity_lock
         Args:
             given_embedding (np.array): the embedding of the given image
+            distance_metric (str): the distance metric
+            threshold (float): the threshold
+            match: the result of check_if_known_embedding, done before taking the lock
         Returns:
             the unique id if the image is known, a new unique id otherwise
     """
-    check = check_if_known_embedding(given_embedding, distance_metric, threshold)
-    if check:
-        return check
+    # Another process may have added this face since the match, or merged the matched
+    # identity into another one, so those cases are matched again
+    folders = [known_embedding_folder] + shared_embedding_folders
+    if not match or not any(os.path.isdir(os.path.join(folder, match)) for folder in folders):
+        match = check_if_known_embedding(given_embedding, distance_metric, threshold)
+
+    if match:
+        # The face may be known from another library, keep its unique id in this one too
+        create_directory_if_not_exists(os.path.join(known_embedding_folder, match))
+        return match
     else:
         unique_id = str(uuid.uuid4().hex)
         create_directory_if_not_exists(os.path.join(known_embedding_folder, unique_id))
         return unique_id
 
+def list_identities():
+    """
+        List all the known identities, the ones with the most faces first
+        Args:
+            None
+        Returns:
+            list: a list of (unique id, number of faces, path to one face image) tuples
+    """
+    identities = []
+    for unique_id in os.listdir(known_embedding_folder):
+        unique_id_dir = os.path.join(known_embedding_folder, unique_id)
+        if not os.path.isdir(unique_id_dir):
+            continue
+        files = os.listdir(unique_id_dir)
+        face_count = sum(1 for f in files if f.endswith(".npy"))
+        face_images = [f for f in files if f.endswith(".png")]
+        face_image = os.path.join(unique_id_dir, face_images[0]) if face_images else None
+        identities.append((unique_id, face_count, face_image))
+    identities.sort(key=lambda identity: identity[1], reverse=True)
+    return identities
+
+def merge_identities(unique_ids: list):
+    """
+        Merge identities of the same person into one, including the stored embeddings
+        Args:
+            unique_ids (list): the unique ids to merge, the first one is kept
+        Returns:
+            the unique id everything was merged into
+    """
+    target = unique_ids[0]
+    target_dir = os.path.join(known_embedding_folder, target)
+    create_directory_if_not_exists(target_dir)
+
+    # Move the embeddings and face images, file names are uuids so they never clash
+    with identity_lock():
+        for unique_id in unique_ids[1:]:
+            unique_id_dir = os.path.join(known_embedding_folder, unique_id)
+            if unique_id == target or not os.path.isdir(unique_id_dir):
+                continue
+            for f in os.listdir(unique_id_dir):
+                shutil.move(os.path.join(unique_id_dir, f), os.path.join(target_dir, f))
+            os.rmdir(unique_id_dir)
+    return target
+
+def load_embedding_index(folder: str = None):
+    """
+        Load all the known embeddings as one matrix, so they can be compared in a single numpy call
+        Only the embeddings added since the last load are read from disk.
+        Args:
+            folder (str): the KNOWN_EMBEDDINGS directory, the one of the current library by default
+        Returns:
+            tuple: the embeddings matrix and the unique id of every row
+    """
+    if folder is None:
+        folder, index_path = known_embedding_folder, embedding_index_path
+    else:
+        index_path = os.path.join(os.path.dirname(folder), "embedding_index.npz")
+
+    # Adding or removing a file changes the mtime of its directory
+    identity_dirs = [entry for entry in os.scandir(folder) if entry.is_dir()] if os.path.isdir(folder) else []
+    signature = np.array([len(identity_dirs), max([entry.stat().st_mtime for entry in identity_dirs], default=0)])
+
+    index = _INDEX_CACHE.get(index_path)
+    if index is None and os.path.exists(index_path):
+        with np.load(index_path) as stored:
+            index = {key: stored[key] for key in stored.files}
+        _INDEX_CACHE[index_path] = index
+    if index is not None and np.array_equal(index["signature"], signature):
+        return index["embeddings"], index["identities"]
+
+    # Rows of the previous index are reused, only new files are loaded
+    previous = {}
+    if index is not None and "files" in index:
+        previous = {file: row for row, file in enumerate(index["files"])}
+    embeddings, identities, files = [], [], []
+    loaded = 0
+    for entry in identity_dirs:
+        try:
+            names = os.listdir(entry.path)
+        except FileNotFoundError:
+            # Merged into another identity meanwhile
+            continue
+        for known_embedding in names:
+            if not known_embedding.endswith(".npy"):
+                continue
+            file = os.path.join(entry.name, known_embedding)
+            if file in previous:
+                embedding = index["embeddings"][previous[file]]
+            else:
+                try:
+                    embedding = np.load(os.path.join(entry.path, known_embedding))
+                except FileNotFoundError:
+                    continue
+                loaded += 1
+            embeddings.append(embedding)
+            identities.append(entry.name)
+            files.append(file)
+
+    index = {
+        "embeddings": np.array(embeddings, dtype=np.float32),
+        "identities": np.array(identities),
+        "files": np.array(files),
+        "signature": signature,
+    }
+    _INDEX_CACHE[index_path] = index
+    if loaded >= INDEX_SAVE_MIN or not os.path.exists(index_path):
+        # Write to a temporary file first, other processes may be reading the index
+        temporary_path = f"{index_path}.{os.getpid()}.npz"
+        np.savez(temporary_path, **index)
+        os.replace(temporary_path, index_path)
+    return index["embeddings"], index["identities"]
+
+def find_distances(
+        embeddings: np.ndarray,
+        given_embedding: np.array,
+        distance_metric: str
+    ):
+    """
+        Same as deepface's find_distance, but against every row of a matrix at once
+        Args:
+            embeddings (np.ndarray): the known embeddings, one per row
+            given_embedding (np.array): the embedding to compare
+            distance_metric (str): the distance metric
+        Returns:
+            np.ndarray: the distance to every row
+    """
+    given_embedding = np.asarray(given_embedding, dtype=np.float32)
+    if distance_metric == "cosine":
+        norms = np.linalg.norm(embeddings, axis=1) * np.linalg.norm(given_embedding)
+        return 1 - (embeddings @ given_embedding) / np.maximum(norms, 1e-10)
+    if distance_metric == "euclidean_l2":
+        embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-10)
+        given_embedding = given_embedding / max(np.linalg.norm(given_embedding), 1e-10)
+    return np.linalg.norm(embeddings - given_embedding, axis=1)
+
+def embed_image(image_path: str, model_name: str):
+    """
+        Get the embeddings of the faces in an image without saving anything
+        Args:
+            image_path (str): the path to the image
+            model_name (str): the name of the model for DeepFace
+        Returns:
+            list: the embeddings of the faces in the image, None if the file is not an image
+    """
+    img = read_image(image_path) if os.path.isfile(image_path) else None
+    if img is None:
+        return None
+    img = cv2.resize(img, (300, 300))
+    try:
+        return [obj["embedding"] for obj in DeepFace.represent(img, model_name = model_name)]
+    except ValueError:
+        return []
+
+def find_similar_identities(
+        query_embeddings: list,
+        distance_metric: str,
+        top_k: int = 20,
+        folder: str = None
+    ):
+    """
+        Find the known identities closest to any of the query embeddings
+        Args:
+            query_embeddings (list): the embeddings to search with
+            distance_metric (str): the distance metric
+            top_k (int): the number of identities to return
+            folder (str): the KNOWN_EMBEDDINGS directory, the one of the current library by default
+        Returns:
+            list: a list of (unique id, distance) tuples, closest first
+    """
+    embeddings, identities = load_embedding_index(folder)
+    if len(embeddings) == 0 or len(query_embeddings) == 0:
+        return []
+
+    # Closest distance of every row to any of the query faces
+    distances = np.min([find_distances(embeddings, query, distance_metric) for query in query_embeddings], axis=0)
+
+    # An identity is as close as its closest embedding
+    closest = {}
+    for unique_id, distance in zip(identities, distances):
+        if distance < closest.get(unique_id, float('inf')):
+            closest[unique_id] = float(distance)
+    return sorted(closest.items(), key=lambda item: item[1])[:top_k]
+
+def identity_embeddings(unique_id: str, folder: str = None):
+    """
+        Get the stored embeddings of a known identity
+        Args:
+            unique_id (str): the unique id of the identity
+            folder (str): the KNOWN_EMBEDDINGS directory, the one of the current library by default
+        Returns:
+            list: the embeddings of the identity
+    """
+    embeddings, identities = load_embedding_index(folder)
+    return list(embeddings[identities == unique_id])
+
 def rec_face_image(
         image_path: str,
         model_name: str,
         distance_metric: str,
-        threshold: str
+        threshold: str,
+        max_pixels: int = DECODE_PIXELS
     ):
     """
         Recognize the face in the given image
@@ -122,15 +371,33 @@ def rec_face_image(
             model_name (str): the name of the model for DeepFace
             distance_metric (str): the distance metric
             threshold (float): the threshold value
+            max_pixels (int): larger images are downscaled while they are decoded
         Returns:
             the unique id of the recognized face
     """
     console.print(f"[bold blue]IMAGE:[/bold blue] {image_path}", style="")
+    return rec_face_array(read_image(image_path, max_pixels), model_name, distance_metric, threshold)
+
+def rec_face_array(
+        img: np.ndarray,
+        model_name: str,
+        distance_metric: str,
+        threshold: str
+    ):
+    """
+        Recognize the face in an already decoded image (e.g. a video frame)
+        Args:
+            img (np.ndarray): the BGR image
+            model_name (str): the name of the model for DeepFace
+            distance_metric (str): the distance metric
+            threshold (float): the threshold value
+        Returns:
+            the unique id of the recognized face
+    """
     try:
 
-        # Read the image and resize it
+        # Resize the image
         # (300, 300) gave me good accuracy opposed to Facent's 224x224 or 256x256
-        img = cv2.imread(image_path)
         img = cv2.resize(img, (300, 300))
 
         # Get all the embeddings of the faces in the image
@@ -141,19 +408,25 @@ def rec_face_image(
         for given_image_obj in given_image_objs:
             given_embedding = given_image_obj["embedding"]
 
-            # Get the unique id for the given embedding
-            unique_id = get_unique_id(given_embedding, distance_metric, threshold)
-            unique_id_dir = os.path.join(known_embedding_folder, unique_id)
-
-            # Save the embedding
-            embedding_path = os.path.join(unique_id_dir, f"{str(uuid.uuid4().hex)}.npy")
-            np.save(embedding_path, given_embedding)
-
-            # Save the face image
+            # Match against the known faces without the lock, it is the slow part
+            match = check_if_known_embedding(given_embedding, distance_metric, threshold)
             x, y, w, h = given_image_obj["facial_area"]["x"], given_image_obj["facial_area"]["y"], given_image_obj["facial_area"]["w"], given_image_obj["facial_area"]["h"]
             roi = img[y:y+h, x:x+w]
-            image_path = os.path.join(unique_id_dir, f"{str(uuid.uuid4().hex)}.png")
-            cv2.imwrite(image_path, roi)
+
+            # Get the unique id and save the embedding and the face image under the lock, so other
+            # processes see the face before they match their next one and a merge can't remove the directory
+            with identity_lock():
+                unique_id = get_unique_id(given_embedding, distance_metric, threshold, match)
+                unique_id_dir = os.path.join(known_embedding_folder, unique_id)
+
+                # Saved under a temporary name, processes matching without the lock never read half a file
+                embedding_path = os.path.join(unique_id_dir, f"{str(uuid.uuid4().hex)}.npy")
+                with open(f"{embedding_path}.tmp", "wb") as f:
+                    np.save(f, given_embedding)
+                os.replace(f"{embedding_path}.tmp", embedding_path)
+
+                face_path = os.path.join(unique_id_dir, f"{str(uuid.uuid4().hex)}.png")
+                cv2.imwrite(face_path, roi)
 
             # append all the unique ids to a list
             all_faces.append(unique_id)
@@ -0,0 +1,9 @@
+# The modules live at the root of the repository, not in a package
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Some modules create ~/.ofts when imported, keep the tests out of the real one
+os.environ["HOME"] = tempfile.mkdtemp(prefix="ofts-tests-")
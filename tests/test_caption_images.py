@@ -0,0 +1,88 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+from PIL import Image
+
+import caption_images
+
+
+class FakeInputs:
+    def __init__(self, count):
+        self.pixel_values = torch.zeros((count, 3, 4, 4))
+
+
+class FakeProcessor:
+    def __call__(self, images, return_tensors):
+        return FakeInputs(len(images))
+
+    def batch_decode(self, generated_ids, skip_special_tokens):
+        return [f"caption {int(ids[0])}" for ids in generated_ids]
+
+
+class FakeModel:
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, pixel_values, **kwargs):
+        self.calls.append(kwargs)
+        return torch.arange(len(pixel_values)).unsqueeze(1)
+
+
+@pytest.fixture
+def fake_git(monkeypatch):
+    loaded = []
+    model = FakeModel()
+
+    def load_GIT(quantized=False):
+        loaded.append(quantized)
+        return FakeProcessor(), model, "cpu"
+
+    monkeypatch.setattr(caption_images, "load_GIT", load_GIT)
+    monkeypatch.setattr(caption_images, "CPU_OPTIMIZED", False)
+    return loaded, model
+
+
+def images(count):
+    return [Image.new("RGB", (8, 8)) for _ in range(count)]
+
+
+def test_cpu_optimized_is_off_by_default(fake_git):
+    loaded, _ = fake_git
+    caption_images.tag_images_GIT(images(1))
+    assert loaded == [False]
+
+
+def test_use_cpu_optimized(fake_git):
+    loaded, _ = fake_git
+    caption_images.use_cpu_optimized()
+    caption_images.tag_images_GIT(images(1))
+    caption_images.tag_images_GIT(images(1), cpu_optimized=False)
+    caption_images.use_cpu_optimized(False)
+    caption_images.tag_images_GIT(images(1))
+    assert loaded == [True, False, False]
+
+
+def test_batch_captions_in_one_greedy_pass(fake_git):
+    _, model = fake_git
+    assert caption_images.tag_images_GIT(images(3), max_length=12) == ["caption 0", "caption 1", "caption 2"]
+    assert model.calls == [{"max_length": 12, "num_beams": 1, "do_sample": False, "use_cache": True}]
+
+
+def test_tag_image_GIT_downscales_large_images(fake_git, tmp_path, monkeypatch):
+    opened = []
+    monkeypatch.setattr(caption_images, "open_image", lambda image_path: opened.append(image_path) or Image.new("RGB", (8, 8)))
+    assert caption_images.tag_image_GIT(str(tmp_path / "a.jpg")) == "caption 0"
+    assert opened == [str(tmp_path / "a.jpg")]
+
+
+def test_configure_cpu_threads(monkeypatch):
+    monkeypatch.setattr(caption_images.os, "cpu_count", lambda: 8)
+    threads = []
+    monkeypatch.setattr(caption_images.torch, "set_num_threads", threads.append)
+    monkeypatch.setattr(caption_images.torch, "set_num_interop_threads", lambda count: None)
+
+    assert caption_images.configure_cpu_threads() == 8
+    assert caption_images.configure_cpu_threads(num_workers=3) == 2
+    assert caption_images.configure_cpu_threads(num_workers=16) == 1
+    assert threads == [8, 2, 1]
@@ -0,0 +1,211 @@
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+import caption_vectors
+import ofts_database as ofts_db
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "ofts.db")
+    ofts_db.initialize_database(db_path=db_path)
+    return db_path
+
+
+@pytest.fixture
+def encoder():
+    return caption_vectors.HashingEncoder()
+
+
+def add_images(db_path, captions):
+    return [
+        (ofts_db.add_image(f"/{i}.jpg", ["unknown"], caption, db_path=db_path), caption)
+        for i, caption in enumerate(captions)
+    ]
+
+
+def stored_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT row, photo_id FROM caption_vectors ORDER BY row").fetchall()
+    finally:
+        conn.close()
+
+
+def test_hashing_encoder_is_normalized_and_deterministic(encoder):
+    vectors = encoder.encode(["a dog on the beach", "a dog on the beach", "a red car"])
+    assert vectors.shape == (3, encoder.dim)
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+    assert np.array_equal(vectors[0], vectors[1])
+    assert vectors[0] @ vectors[1] > vectors[0] @ vectors[2]
+
+
+def test_add_caption_vectors_skips_images_that_have_one(db_path, encoder):
+    captions = add_images(db_path, ["a dog", "a cat", "a car"])
+    assert caption_vectors.add_caption_vectors(db_path, captions[:2], encoder) == 2
+    assert caption_vectors.add_caption_vectors(db_path, captions, encoder) == 1
+    assert caption_vectors.add_caption_vectors(db_path, captions, encoder) == 0
+
+    # No gaps, and the file holds exactly one row per image
+    rows = stored_rows(db_path)
+    assert [row for row, _ in rows] == [0, 1, 2]
+    assert sorted(photo_id for _, photo_id in rows) == sorted(photo_id for photo_id, _ in captions)
+    assert os.path.getsize(caption_vectors.vectors_path(db_path)) == 3 * encoder.dim * 2
+    assert caption_vectors.vectors_consistent(db_path)
+
+
+def test_add_caption_vectors_ignores_images_that_were_not_added(db_path, encoder):
+    captions = add_images(db_path, ["a dog"]) + [(None, "a cat")]
+    assert caption_vectors.add_caption_vectors(db_path, captions, encoder) == 1
+
+
+def test_load_caption_vectors_maps_rows_by_row(db_path, encoder):
+    captions = add_images(db_path, ["a dog", "a cat", "a car"])
+    caption_vectors.add_caption_vectors(db_path, captions, encoder)
+
+    # Rows are mapped by the row column, not by their order in the table
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM caption_vectors WHERE row = 1")
+    conn.commit()
+    conn.close()
+    caption_vectors.rebuild_vector_ids(db_path, force=True)
+
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    assert len(matrix) == 3
+    assert photo_ids.tolist() == [captions[0][0], -1, captions[2][0]]
+    assert np.allclose(np.asarray(matrix[2], dtype=np.float32), encoder.encode(["a car"])[0], atol=1e-3)
+
+    # A row without an image is never returned
+    found = [photo_id for photo_id, _ in caption_vectors.vector_search(db_path, "a cat", top_k=3)]
+    assert sorted(found) == sorted([captions[0][0], captions[2][0]])
+
+
+def test_add_caption_vectors_drops_rows_of_a_dead_process(db_path, encoder):
+    captions = add_images(db_path, ["a dog", "a cat"])
+    caption_vectors.add_caption_vectors(db_path, captions[:1], encoder)
+
+    # A process that wrote its vectors but died before committing
+    with open(caption_vectors.vectors_path(db_path), "ab") as f:
+        f.write(np.zeros((5, encoder.dim), dtype=np.float16).tobytes())
+
+    caption_vectors.add_caption_vectors(db_path, captions[1:], encoder)
+    assert [row for row, _ in stored_rows(db_path)] == [0, 1]
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    assert photo_ids.tolist() == [captions[0][0], captions[1][0]]
+    assert caption_vectors.vector_search(db_path, "a cat", top_k=1)[0][0] == captions[1][0]
+
+
+def test_backfill_caption_vectors(db_path, encoder):
+    captions = add_images(db_path, [f"photo number {i}" for i in range(7)])
+    caption_vectors.add_caption_vectors(db_path, captions[:2], encoder)
+
+    assert caption_vectors.backfill_caption_vectors(db_path, "hashing", batch_size=2) == 5
+    assert caption_vectors.backfill_caption_vectors(db_path, "hashing", batch_size=2) == 0
+    assert [row for row, _ in stored_rows(db_path)] == list(range(7))
+    assert caption_vectors.stored_encoder(db_path) == "hashing"
+
+
+def test_backfill_repairs_inconsistent_vectors(db_path, encoder):
+    captions = add_images(db_path, ["a dog", "a cat"])
+    caption_vectors.add_caption_vectors(db_path, captions, encoder)
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE caption_vectors SET row = 5 WHERE row = 1")
+    conn.commit()
+    conn.close()
+    assert not caption_vectors.vectors_consistent(db_path)
+
+    assert caption_vectors.backfill_caption_vectors(db_path, "hashing") == 2
+    assert caption_vectors.vectors_consistent(db_path)
+
+
+def test_normalize_scores():
+    assert caption_vectors.normalize_scores({}) == {}
+    assert caption_vectors.normalize_scores({1: 3.0, 2: 3.0}) == {1: 1.0, 2: 1.0}
+    assert caption_vectors.normalize_scores({1: 1.0, 2: 2.0, 3: 3.0}) == {1: 0.0, 2: 0.5, 3: 1.0}
+
+
+def test_hybrid_search_leaves_out_unrelated_images(db_path):
+    add_images(db_path, ["a dog on the beach", "a dog in the park", "a red sports car", "a plate of pasta"])
+    caption_vectors.backfill_caption_vectors(db_path, "hashing")
+
+    results = caption_vectors.hybrid_search(db_path, "dog beach")
+    paths = [image_path for image_path, _, _, _ in results]
+    assert paths[0] == "/0.jpg"
+    assert "/2.jpg" not in paths and "/3.jpg" not in paths
+    assert all(score > caption_vectors.MIN_SCORE for _, _, _, score in results)
+    assert results == sorted(results, key=lambda result: result[3], reverse=True)
+
+
+def test_load_caption_vectors_reads_the_mapping_file(db_path, encoder, monkeypatch):
+    captions = add_images(db_path, ["a dog", "a cat"])
+    caption_vectors.add_caption_vectors(db_path, captions, encoder)
+    assert np.fromfile(caption_vectors.ids_path(db_path), dtype=np.int64).tolist() == [photo_id for photo_id, _ in captions]
+
+    # Searching never reads the row -> image table
+    def write_vector_ids(*args):
+        raise AssertionError("the mapping was read from the table")
+
+    monkeypatch.setattr(caption_vectors, "write_vector_ids", write_vector_ids)
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    assert photo_ids.tolist() == [photo_id for photo_id, _ in captions]
+
+
+def test_mapping_file_is_built_for_older_libraries(db_path, encoder):
+    captions = add_images(db_path, ["a dog", "a cat", "a car"])
+    caption_vectors.add_caption_vectors(db_path, captions[:2], encoder)
+    os.remove(caption_vectors.ids_path(db_path))
+
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    assert photo_ids.tolist() == [captions[0][0], captions[1][0]]
+
+    os.remove(caption_vectors.ids_path(db_path))
+    caption_vectors.add_caption_vectors(db_path, captions[2:], encoder)
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    assert photo_ids.tolist() == [photo_id for photo_id, _ in captions]
+
+
+def test_drop_caption_vectors_removes_the_files(db_path, encoder):
+    caption_vectors.add_caption_vectors(db_path, add_images(db_path, ["a dog"]), encoder)
+    caption_vectors.drop_caption_vectors(db_path)
+    assert not os.path.exists(caption_vectors.vectors_path(db_path))
+    assert not os.path.exists(caption_vectors.ids_path(db_path))
+    assert caption_vectors.load_caption_vectors(db_path)[0] is None
+
+
+def test_backfill_resumes_after_the_last_batch(db_path, encoder):
+    captions = add_images(db_path, [f"photo number {i}" for i in range(9)])
+    caption_vectors.add_caption_vectors(db_path, captions[3:5], encoder)
+
+    batches = []
+    add_caption_vectors = caption_vectors.add_caption_vectors
+
+    def record(db_path, captions, encoder=None):
+        batches.append([photo_id for photo_id, _ in captions])
+        return add_caption_vectors(db_path, captions, encoder)
+
+    caption_vectors.add_caption_vectors = record
+    try:
+        assert caption_vectors.backfill_caption_vectors(db_path, "hashing", batch_size=3) == 7
+    finally:
+        caption_vectors.add_caption_vectors = add_caption_vectors
+    photo_ids = [photo_id for photo_id, _ in captions]
+    assert batches == [photo_ids[0:3], photo_ids[5:8], photo_ids[8:9]]
+
+
+def test_vector_search_matches_a_full_scan(db_path, encoder, monkeypatch):
+    captions = add_images(db_path, [f"photo {i} of a {['dog', 'cat', 'car'][i % 3]}" for i in range(50)])
+    caption_vectors.add_caption_vectors(db_path, captions, encoder)
+    monkeypatch.setattr(caption_vectors, "SEARCH_CHUNK", 4)
+    monkeypatch.setattr(caption_vectors, "SEARCH_THREADS", 3)
+    monkeypatch.setattr(caption_vectors.os, "cpu_count", lambda: 8)
+
+    matrix, photo_ids = caption_vectors.load_caption_vectors(db_path)
+    scores = np.asarray(matrix, dtype=np.float32) @ encoder.encode(["a dog"])[0]
+    by_id = dict(zip(photo_ids.tolist(), scores.tolist()))
+    found = caption_vectors.vector_search(db_path, "a dog", top_k=10)
+    # Ties may come out in any order, the scores may not
+    assert np.allclose([score for _, score in found], np.sort(scores)[::-1][:10])
+    assert all(np.isclose(by_id[photo_id], score) for photo_id, score in found)
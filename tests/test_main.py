@@ -0,0 +1,157 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("magic")
+pytest.importorskip("deepface")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import main
+import ofts_database as ofts_db
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "ofts.db")
+    ofts_db.initialize_database(db_path=db_path)
+    monkeypatch.setattr(main, "DB_PATH", db_path)
+    monkeypatch.setattr(main, "list_identities", lambda: [("id1", 5, None), ("id2", 2, None), ("id3", 1, None)])
+    merged = []
+    monkeypatch.setattr(main, "merge_identities", lambda face_ids: merged.append(list(face_ids)))
+    return db_path, merged
+
+
+def test_bulk_naming_merges_faces_with_the_same_name(library):
+    db_path, merged = library
+    for image_path, faces in [("/1.jpg", ["id1"]), ("/2.jpg", ["id2", "id3"])]:
+        ofts_db.add_image(image_path, faces, "x", db_path=db_path)
+
+    assert main.bulk_change_face_names({"id2": "Alice", "id3": "Bob", "id9": "Carol"}) == 1
+    assert merged == []
+
+    # id1 joins the faces already named Alice and is kept, it has the most faces
+    assert main.bulk_change_face_names({"id1": "Alice"}) == 1
+    assert merged == [["id1", "id2"]]
+    assert ofts_db.get_face_names(db_path) == {"id1": "Alice", "id2": "Alice", "id3": "Bob"}
+
+
+def test_bulk_naming_renamed_face_leaves_its_old_group(library):
+    db_path, merged = library
+    ofts_db.add_image("/1.jpg", ["id2", "id3"], "x", db_path=db_path)
+    main.bulk_change_face_names({"id2": "Alice", "id3": "Bob"})
+
+    # id3 is no longer Bob, so it is merged with Alice only
+    main.bulk_change_face_names({"id3": "Alice"})
+    assert merged == [["id2", "id3"]]
+
+
+def test_bulk_naming_writes_the_database_before_merging(library, monkeypatch):
+    db_path, merged = library
+    ofts_db.add_image("/1.jpg", ["id1", "id2"], "x", db_path=db_path)
+
+    monkeypatch.setattr(main.ofts_db, "name_faces_bulk", lambda db_path, face_names: None)
+    assert main.bulk_change_face_names({"id1": "Alice", "id2": "Alice"}) is None
+    assert merged == []
+
+
+def test_search_similar_images_by_name(library, tmp_path, monkeypatch):
+    db_path, _ = library
+    folder = str(tmp_path / "KNOWN_EMBEDDINGS")
+    for unique_id, embedding in [("id1", [1, 0]), ("id2", [0.6, 0.8]), ("id3", [0, 1])]:
+        os.makedirs(os.path.join(folder, unique_id))
+        np.save(os.path.join(folder, unique_id, "a.npy"), np.array(embedding, dtype=np.float32))
+    shard = {"name": "default", "root": "", "db_path": db_path, "embeddings_dir": folder, "attached": 1}
+    monkeypatch.setattr(main.ofts_shards, "list_shards", lambda attached_only=True: [shard])
+    monkeypatch.setattr(main, "embed_image", lambda query, model_name: pytest.fail("known faces need no DeepFace"))
+    for image_path, faces in [("/1.jpg", ["id3"]), ("/2.jpg", ["id1"]), ("/3.jpg", ["id2", "id3"])]:
+        ofts_db.add_image(image_path, faces, "x", db_path=db_path)
+    ofts_db.name_faces_bulk(db_path, {"id1": "Alice Smith"})
+
+    results = main.search_similar_images("alice smith", "Facenet", "cosine", top_k=2)
+    assert [row[0] for row in results] == ["/2.jpg", "/3.jpg"]
+
+
+def test_a_failing_video_does_not_end_the_ingestion(library, tmp_path, monkeypatch):
+    import cv2
+
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    for name in ("a.avi", "b.avi"):
+        writer = cv2.VideoWriter(str(library_dir / name), cv2.VideoWriter_fourcc(*"MJPG"), 10, (32, 32))
+        writer.write(np.zeros((32, 32, 3), dtype=np.uint8))
+        writer.release()
+    videos = []
+
+    def process_video(video_path, *args, **kwargs):
+        videos.append(os.path.basename(video_path))
+        if len(videos) == 1:
+            raise RuntimeError("model failure")
+        return 1
+
+    monkeypatch.setattr(main, "process_video", process_video)
+    main.walk_through_files(str(library_dir), "Facenet", "cosine", 0.4)
+    assert sorted(videos) == ["a.avi", "b.avi"]
+
+
+def test_every_file_belongs_to_one_worker():
+    files = [f"/photos/{number}.jpg" for number in range(200)]
+    workers = [main.worker_of(file_path, 3) for file_path in files]
+    assert set(workers) == {0, 1, 2}
+    assert workers == [main.worker_of(file_path, 3) for file_path in files]
+    assert {main.worker_of(file_path, 1) for file_path in files} == {0}
+
+
+def test_maintenance_only_merges_while_images_are_added(library, monkeypatch):
+    db_path, _ = library
+    calls = []
+    monkeypatch.setattr(main.ofts_db, "optimize_database", lambda db_path: calls.append("optimize"))
+    monkeypatch.setattr(main.ofts_db, "merge_index", lambda db_path: calls.append("merge"))
+
+    with ofts_db.ingestion_lock(db_path):
+        main.maintain_database()
+    main.maintain_database()
+    assert calls == ["merge", "optimize"]
+
+
+ALLOCATION_ERROR = RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 1073741824 bytes")
+
+
+def test_store_images_shrinks_the_batches_on_a_failed_allocation(library, tmp_path, monkeypatch):
+    from PIL import Image
+
+    db_path, _ = library
+    paths = []
+    for name in ("a.jpg", "b.jpg"):
+        Image.new("RGB", (16, 16)).save(tmp_path / name)
+        paths.append(str(tmp_path / name))
+
+    def tag_images_GIT(images):
+        if len(images) > 1:
+            raise ALLOCATION_ERROR
+        return ["A dog"]
+
+    monkeypatch.setattr(main, "tag_images_GIT", tag_images_GIT)
+    monkeypatch.setattr(main, "CAPTION_ENCODER", main.caption_vectors.HashingEncoder.name)
+    budget = main.MemoryBudget(batch_size=4)
+    assert main.store_images([(path, ["alice"]) for path in paths], budget) == 2
+    assert budget.batch_size == 2
+    assert len(ofts_db.search_images("dog", db_path)) == 2
+
+
+def test_a_failed_allocation_while_recognizing_faces_shrinks_the_batches(library, tmp_path, monkeypatch):
+    from PIL import Image
+
+    library_dir = tmp_path / "library"
+    library_dir.mkdir()
+    Image.new("RGB", (16, 16)).save(library_dir / "a.jpg")
+    shrunk = []
+    monkeypatch.setattr(main.MemoryBudget, "shrink", lambda budget: shrunk.append(True))
+
+    def rec_face_image(*args, **kwargs):
+        raise ALLOCATION_ERROR
+
+    monkeypatch.setattr(main, "rec_face_image", rec_face_image)
+    main.walk_through_files(str(library_dir), "Facenet", "cosine", 0.4)
+    assert shrunk == [True]
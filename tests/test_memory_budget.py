@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import memory_budget
+from memory_budget import MemoryBudget, parse_size
+
+
+@pytest.mark.parametrize("size, expected", [
+    ("512M", 512 * 1024 ** 2),
+    ("4G", 4 * 1024 ** 3),
+    ("4gb", 4 * 1024 ** 3),
+    ("1.5G", int(1.5 * 1024 ** 3)),
+    ("64K", 64 * 1024),
+    (" 2T ", 2 * 1024 ** 4),
+    ("4096", 4096 * 1024 ** 2),
+])
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_rejects_garbage():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_max_pixels():
+    assert MemoryBudget().max_pixels == memory_budget.DECODE_PIXELS
+    assert MemoryBudget(parse_size("64G")).max_pixels == memory_budget.DECODE_PIXELS
+    assert MemoryBudget(parse_size("1M")).max_pixels == memory_budget.MIN_DECODE_PIXELS
+    budget = MemoryBudget(parse_size("64M"))
+    assert memory_budget.MIN_DECODE_PIXELS < budget.max_pixels < memory_budget.DECODE_PIXELS
+
+
+def test_batch_size_adapts_to_the_rss(monkeypatch):
+    budget = MemoryBudget(1000, batch_size=4, max_batch_size=6)
+    rss = {"value": 100}
+    monkeypatch.setattr(memory_budget, "current_rss", lambda: rss["value"])
+
+    # Grows by one while there is room, never past the maximum
+    assert [budget.update() for _ in range(4)] == [5, 6, 6, 6]
+
+    # Halves close to the budget, never below one
+    rss["value"] = 950
+    assert [budget.update() for _ in range(4)] == [3, 1, 1, 1]
+
+    # Stays put in between
+    rss["value"] = 700
+    assert budget.update() == 1
+
+
+def test_no_budget_keeps_the_batch_size(monkeypatch):
+    monkeypatch.setattr(memory_budget, "current_rss", lambda: 10 ** 12)
+    budget = MemoryBudget(batch_size=4)
+    assert budget.update() == 4
+    assert budget.shrink() == 2
+
+
+def test_current_rss():
+    assert memory_budget.current_rss() > 0
+
+
+def test_current_rss_fallback_units(monkeypatch):
+    class Usage:
+        ru_maxrss = 1000
+
+    # No /proc/self/statm
+    def no_proc(*args, **kwargs):
+        raise OSError()
+
+    monkeypatch.setattr(memory_budget, "open", no_proc, raising=False)
+    monkeypatch.setattr(memory_budget.resource, "getrusage", lambda who: Usage())
+    monkeypatch.setattr(memory_budget.sys, "platform", "darwin")
+    assert memory_budget.current_rss() == 1000
+    monkeypatch.setattr(memory_budget.sys, "platform", "freebsd14")
+    assert memory_budget.current_rss() == 1000 * 1024
+
+
+@pytest.fixture
+def large_image(tmp_path):
+    path = str(tmp_path / "large.jpg")
+    Image.fromarray(np.random.default_rng(0).integers(0, 255, (1200, 1600, 3), dtype=np.uint8)).save(path)
+    return path
+
+
+def test_open_image_downscales(large_image):
+    image = memory_budget.open_image(large_image, max_pixels=200_000)
+    assert image.mode == "RGB"
+    assert image.width * image.height <= 200_000
+    assert memory_budget.open_image(large_image).size == (1600, 1200)
+
+
+def test_read_image_downscales(large_image):
+    image = memory_budget.read_image(large_image, max_pixels=200_000)
+    assert image.shape[0] * image.shape[1] <= 200_000
+    assert memory_budget.read_image(large_image).shape == (1200, 1600, 3)
+
+
+def test_read_image_of_a_missing_file(tmp_path):
+    assert memory_budget.read_image(str(tmp_path / "missing.jpg")) is None
+
+
+@pytest.mark.parametrize("error, expected", [
+    (MemoryError(), True),
+    (RuntimeError("[enforce fail at alloc_cpu.cpp:117] DefaultCPUAllocator: can't allocate memory: you tried to allocate 1073741824 bytes"), True),
+    (RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"), True),
+    (Exception("OOM when allocating tensor with shape[64,3,300,300]"), True),
+    (RuntimeError("Input type (double) and bias type (float) should be the same"), False),
+    (ValueError("Face could not be detected"), False),
+])
+def test_is_out_of_memory(error, expected):
+    assert memory_budget.is_out_of_memory(error) is expected
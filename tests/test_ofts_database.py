@@ -0,0 +1,266 @@
+import sqlite3
+
+import pytest
+
+import ofts_database as ofts_db
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "ofts.db")
+    ofts_db.initialize_database(db_path=db_path)
+    return db_path
+
+
+def add_images(db_path, images):
+    return [ofts_db.add_image(image_path, faces, caption, db_path=db_path) for image_path, faces, caption in images]
+
+
+def test_name_faces_bulk_updates_the_indexes(db_path):
+    add_images(db_path, [("/1.jpg", ["id1", "id2"], "x"), ("/2.jpg", ["id1"], "x")])
+    ofts_db.add_video_frames("/v.mp4", [(1.0, ["id1"], "a dog")], db_path=db_path)
+
+    assert ofts_db.name_faces_bulk(db_path, {"id1": "alice", "id2": "Bob Smith"}) == 3
+    assert sorted(row[0] for row in ofts_db.search_people(db_path, ["alice"])) == ["/1.jpg", "/2.jpg"]
+    assert ofts_db.search_people(db_path, ["id1"]) == []
+    assert ofts_db.co_occurring_people(db_path, "alice") == [("Bob_Smith", 1)]
+    assert ofts_db.search_video_frames("faces:alice", db_path) == [("/v.mp4", 1.0, "alice", "a dog")]
+
+    # Images added later get the name directly
+    add_images(db_path, [("/3.jpg", ["id1"], "x")])
+    assert len(ofts_db.search_people(db_path, ["alice"])) == 3
+
+
+def test_name_faces_bulk_renames_a_named_face(db_path):
+    add_images(db_path, [("/1.jpg", ["id1", "id2"], "x"), ("/2.jpg", ["id2"], "x")])
+    ofts_db.add_video_frames("/v.mp4", [(1.0, ["id1"], "a dog")], db_path=db_path)
+    ofts_db.name_faces_bulk(db_path, {"id1": "Alice", "id2": "Bob"})
+
+    assert ofts_db.name_faces_bulk(db_path, {"id1": "Alicia"}) == 2
+    assert ofts_db.get_face_names(db_path) == {"id1": "Alicia", "id2": "Bob"}
+    assert [row[0] for row in ofts_db.search_people(db_path, ["Alicia"])] == ["/1.jpg"]
+    assert ofts_db.search_people(db_path, ["Alice"]) == []
+    assert ofts_db.co_occurring_people(db_path, "Bob") == [("Alicia", 1)]
+    assert ofts_db.search_video_frames("faces:alicia", db_path) == [("/v.mp4", 1.0, "Alicia", "a dog")]
+
+    # Swapping two names replaces each old name once
+    assert ofts_db.name_faces_bulk(db_path, {"id1": "Bob", "id2": "Alicia"}) == 3
+    assert [row[1] for row in ofts_db.show_all_at_once(db_path)] == ["Bob Alicia", "Alicia"]
+
+
+def test_name_faces_bulk_returns_none_on_failure(db_path, monkeypatch):
+    add_images(db_path, [("/1.jpg", ["id1"], "x")])
+
+    def fail(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(ofts_db, "index_words", fail)
+    assert ofts_db.name_faces_bulk(db_path, {"id1": "alice"}) is None
+    assert ofts_db.get_face_names(db_path) == {}
+
+
+def test_search_people(db_path):
+    add_images(db_path, [
+        ("/1.jpg", ["alice", "bob"], "x"),
+        ("/2.jpg", ["alice", "carol"], "x"),
+        ("/3.jpg", ["alice", "bob", "carol"], "x"),
+        ("/4.jpg", ["bob"], "x"),
+    ])
+    paths = lambda results: sorted(row[0] for row in results)
+    assert paths(ofts_db.search_people(db_path, ["alice"])) == ["/1.jpg", "/2.jpg", "/3.jpg"]
+    assert paths(ofts_db.search_people(db_path, ["alice", "bob"])) == ["/1.jpg", "/3.jpg"]
+    assert paths(ofts_db.search_people(db_path, ["alice"], ["carol"])) == ["/1.jpg"]
+    assert paths(ofts_db.search_people(db_path, ["alice", "bob"], ["carol"])) == ["/1.jpg"]
+    assert ofts_db.search_people(db_path, []) == []
+
+
+def test_co_occurring_people(db_path):
+    add_images(db_path, [
+        ("/1.jpg", ["alice", "bob"], "x"),
+        ("/2.jpg", ["alice", "bob", "unknown"], "x"),
+        ("/3.jpg", ["alice", "carol"], "x"),
+    ])
+    assert ofts_db.co_occurring_people(db_path, "alice") == [("bob", 2), ("carol", 1)]
+    assert ofts_db.co_occurring_people(db_path, "alice", limit=1) == [("bob", 2)]
+    assert ofts_db.co_occurring_people(db_path, "carol") == [("alice", 1)]
+
+
+def test_people_are_found_regardless_of_case_and_spaces(db_path):
+    add_images(db_path, [("/1.jpg", ["id1", "id2"], "x"), ("/2.jpg", ["id2"], "x")])
+    ofts_db.name_faces_bulk(db_path, {"id1": "Alice Smith", "id2": "Bob"})
+
+    assert [row[0] for row in ofts_db.search_people(db_path, ["alice smith"])] == ["/1.jpg"]
+    assert [row[0] for row in ofts_db.search_people(db_path, ["BOB"], ["ALICE_SMITH"])] == ["/2.jpg"]
+    assert ofts_db.co_occurring_people(db_path, "bob") == [("Alice_Smith", 1)]
+    assert [row[:2] for row in ofts_db.images_of_people(db_path, ["alice smith"])] == [("alice smith", "/1.jpg")]
+
+
+def test_person_index_is_built_for_older_databases(tmp_path):
+    db_path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE VIRTUAL TABLE photos USING fts5(image_path, faces, caption)")
+    conn.execute("INSERT INTO photos VALUES ('/1.jpg', 'Alice bob', 'x')")
+    conn.commit()
+    conn.close()
+
+    assert ofts_db.add_image("/2.jpg", ["alice"], "y", db_path=db_path) is not None
+    assert sorted(row[0] for row in ofts_db.search_people(db_path, ["alice"])) == ["/1.jpg", "/2.jpg"]
+    assert ofts_db.co_occurring_people(db_path, "alice") == [("bob", 1)]
+
+
+def test_searching_people_does_not_take_the_write_lock(db_path, monkeypatch):
+    add_images(db_path, [("/1.jpg", ["alice"], "x")])
+
+    def begin_write(conn):
+        raise AssertionError("a search of an up to date database took the write lock")
+
+    monkeypatch.setattr(ofts_db, "begin_write", begin_write)
+    writer = ofts_db.connect(db_path)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        ofts_db.rebuild_person_index(db_path)
+        assert [row[0] for row in ofts_db.search_people(db_path, ["alice"])] == ["/1.jpg"]
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("dog beach", '"dog" AND "beach"*'),
+    ("a dog on the beach", '"dog" AND "beach"*'),
+    # A trailing stop word is dropped, not kept as a required prefix
+    ("dog on the", '"dog"'),
+    ("the", ""),
+    ("", ""),
+    ("dog OR cat", '"dog" OR "cat"*'),
+    ("dog NOT", '"dog"'),
+    ("OR dog", '"dog"*'),
+    ('say "cheese', '"say" AND "cheese"*'),
+    ("dog -", '"dog"'),
+    ("faces:alice dog", 'faces:"alice" AND "dog"*'),
+    ("Caption:the", 'caption:"the"*'),
+    ("path:alice", '"path:alice"*'),
+])
+def test_prepare_query(query, expected):
+    assert ofts_db.prepare_query(query) == expected
+
+
+def test_prepare_query_without_type_ahead():
+    assert ofts_db.prepare_query("dog beach", type_ahead=False) == '"dog" AND "beach"'
+    assert ofts_db.prepare_query("dog beach", type_ahead=False, any_word=True) == '"dog" OR "beach"'
+
+
+def test_search_stems_complete_words(db_path):
+    add_images(db_path, [("/a.jpg", ["alice"], "a dog on the beaches")])
+    assert [row[0] for row in ofts_db.search_images("beach", db_path)] == ["/a.jpg"]
+
+
+def test_search_partial_word_under_stemming(db_path):
+    # "beautiful" is indexed as "beauti", a plain "beautif"* prefix finds nothing
+    add_images(db_path, [("/a.jpg", ["alice"], "a beautiful sunset"), ("/b.jpg", ["bob"], "a dog")])
+    assert [row[0] for row in ofts_db.search_images("beautif", db_path)] == ["/a.jpg"]
+    assert [row[0] for row in ofts_db.search_images("sunset beautif", db_path)] == ["/a.jpg"]
+
+
+def test_search_trailing_stop_word(db_path):
+    add_images(db_path, [("/a.jpg", ["alice"], "a dog on a couch")])
+    assert [row[0] for row in ofts_db.search_images("dog on the", db_path)] == ["/a.jpg"]
+
+
+def test_search_column_filter(db_path):
+    add_images(db_path, [("/a.jpg", ["alice"], "a dog"), ("/b.jpg", ["bob"], "alice in wonderland")])
+    assert [row[0] for row in ofts_db.search_images("faces:alice", db_path)] == ["/a.jpg"]
+    assert [row[0] for row in ofts_db.search_images("caption:alice", db_path)] == ["/b.jpg"]
+
+
+def test_search_words_are_built_for_older_databases(db_path):
+    add_images(db_path, [("/a.jpg", ["alice"], "a beautiful sunset")])
+    conn = sqlite3.connect(db_path)
+    conn.execute("DROP TABLE search_words")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    ofts_db.rebuild_person_index(db_path)
+    assert [row[0] for row in ofts_db.search_images("beautif", db_path)] == ["/a.jpg"]
+
+
+def test_optimize_database_upgrades_the_index_and_keeps_rowids(tmp_path):
+    db_path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE VIRTUAL TABLE photos USING fts5(image_path, faces, caption)")
+    conn.commit()
+    conn.close()
+    photo_ids = add_images(db_path, [("/1.jpg", ["alice"], "a dog"), ("/2.jpg", ["bob"], "the beaches")])
+
+    ofts_db.optimize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'photos'").fetchone()[0]
+    conn.close()
+    assert ofts_db.fts_options(ofts_db.FTS_PREFIX, ofts_db.FTS_TOKENIZER) in sql
+    assert ofts_db.get_images(db_path, photo_ids) == {photo_ids[0]: ("/1.jpg", "alice", "a dog"), photo_ids[1]: ("/2.jpg", "bob", "the beaches")}
+    assert [row[0] for row in ofts_db.search_images("beach", db_path)] == ["/2.jpg"]
+    assert [row[0] for row in ofts_db.search_people(db_path, ["bob"])] == ["/2.jpg"]
+
+
+def test_merge_index_keeps_the_results(db_path):
+    add_images(db_path, [(f"/{number}.jpg", ["alice"], f"dog number{number}") for number in range(20)])
+    ofts_db.merge_index(db_path, pages=10)
+    assert len(ofts_db.search_images("dog", db_path)) == 20
+
+
+def test_maintenance_does_not_wait_for_the_ingestion(db_path):
+    with ofts_db.ingestion_lock(db_path) as locked:
+        assert locked
+        # Another process adding images at the same time
+        with ofts_db.ingestion_lock(db_path):
+            with ofts_db.ingestion_lock(db_path, exclusive=True) as locked:
+                assert not locked
+    with ofts_db.ingestion_lock(db_path, exclusive=True) as locked:
+        assert locked
+
+
+def add_from_process(db_path, worker_index):
+    for number in range(20):
+        assert ofts_db.add_image(f"/{worker_index}/{number}.jpg", ["alice", f"p{worker_index}"], "x", db_path=db_path) is not None
+
+
+def test_processes_add_images_at_the_same_time(db_path):
+    import multiprocessing
+
+    processes = [multiprocessing.get_context("fork").Process(target=add_from_process, args=(db_path, index)) for index in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0, 0]
+    assert len(ofts_db.search_people(db_path, ["alice"])) == 80
+    assert sorted(ofts_db.co_occurring_people(db_path, "alice")) == [(f"p{index}", 20) for index in range(4)]
+
+
+def test_add_image_returns_the_rowid_only_when_added(db_path, monkeypatch):
+    photo_id = ofts_db.add_image("/a.jpg", ["alice"], "x", db_path=db_path)
+    assert ofts_db.get_images(db_path, [photo_id]) == {photo_id: ("/a.jpg", "alice", "x")}
+
+    # The insert went through, but the transaction didn't
+    def fail(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(ofts_db, "index_words", fail)
+    assert ofts_db.add_image("/b.jpg", ["bob"], "y", db_path=db_path) is None
+    assert ofts_db.search_people(db_path, ["bob"]) == []
+
+
+def test_search_image_ids_ranks_all_the_words_first(db_path):
+    add_images(db_path, [
+        ("/1.jpg", ["alice"], "a dog"),
+        ("/2.jpg", ["alice"], "a beach"),
+        ("/3.jpg", ["alice"], "a dog on the beach"),
+        ("/4.jpg", ["alice"], "a red car"),
+    ])
+    ranked = lambda **kwargs: [ofts_db.get_images(db_path, [photo_id])[photo_id][0] for photo_id, _ in ofts_db.search_image_ids("dog beach", db_path, **kwargs)]
+    assert ranked()[0] == "/3.jpg"
+    assert sorted(ranked()) == ["/1.jpg", "/2.jpg", "/3.jpg"]
+    assert ranked(limit=1) == ["/3.jpg"]
+    # Only the first matches of every query are ranked
+    assert ranked(candidates=1) == ["/3.jpg", "/1.jpg"]
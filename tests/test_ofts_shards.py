@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import ofts_database as ofts_db
+import ofts_shards
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    os.makedirs(tmp_path / ".ofts")
+    monkeypatch.setattr(ofts_shards, "home", tmp_path)
+    monkeypatch.setattr(ofts_shards, "CATALOG_PATH", str(tmp_path / ".ofts" / "catalog.db"))
+    monkeypatch.setattr(ofts_shards, "SHARDS_DIR", str(tmp_path / ".ofts" / "shards"))
+    return tmp_path
+
+
+def test_the_default_library_is_registered(catalog):
+    assert ofts_shards.list_shards() == [{
+        "name": "default",
+        "root": "",
+        "db_path": f"{catalog}/.ofts/ofts.db",
+        "embeddings_dir": f"{catalog}/.ofts/KNOWN_EMBEDDINGS",
+        "attached": 1,
+    }]
+
+
+def test_list_shards_only_reads_the_catalog(catalog, monkeypatch):
+    ofts_shards.initialize_catalog()
+
+    def initialize_catalog():
+        raise AssertionError("list_shards wrote the catalog")
+
+    monkeypatch.setattr(ofts_shards, "initialize_catalog", initialize_catalog)
+    assert [shard["name"] for shard in ofts_shards.list_shards()] == ["default"]
+
+
+def test_add_detach_and_attach_libraries(catalog, tmp_path):
+    shard = ofts_shards.add_shard("work", str(tmp_path / "photos"))
+    assert shard["root"] == str(tmp_path / "photos")
+    assert os.path.exists(shard["db_path"])
+    assert os.path.isdir(shard["embeddings_dir"])
+
+    ofts_shards.detach_shard("work")
+    assert [shard["name"] for shard in ofts_shards.list_shards()] == ["default"]
+    assert [shard["name"] for shard in ofts_shards.list_shards(attached_only=False)] == ["default", "work"]
+
+    ofts_shards.attach_shard("work")
+    assert [shard["name"] for shard in ofts_shards.list_shards()] == ["default", "work"]
+    assert ofts_shards.get_shard("missing") is None
+
+
+def test_search_all_shards_merges_by_rank(catalog, tmp_path):
+    ofts_shards.add_shard("a", str(tmp_path / "a"))
+    ofts_shards.add_shard("b", str(tmp_path / "b"))
+    ofts_db.add_image("/a/1.jpg", ["alice"], "a dog", db_path=ofts_shards.get_shard("a")["db_path"])
+    ofts_db.add_image("/a/2.jpg", ["alice"], "a cat", db_path=ofts_shards.get_shard("a")["db_path"])
+    ofts_db.add_image("/b/1.jpg", ["bob"], "a dog and a dog and a dog", db_path=ofts_shards.get_shard("b")["db_path"])
+
+    # The default library has no database yet, it is left out
+    assert [row[0] for row in ofts_shards.search_all_shards("dog")] == ["/b/1.jpg", "/a/1.jpg"]
+    assert sorted(ofts_shards.fan_out(lambda db_path: [db_path])) == [
+        ofts_shards.get_shard("a")["db_path"], ofts_shards.get_shard("b")["db_path"],
+    ]
+    assert ofts_shards.fan_out(lambda db_path: [db_path], [ofts_shards.get_shard("default")]) == []
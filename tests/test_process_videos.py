@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("deepface")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import ofts_database as ofts_db
+import process_videos
+
+
+def write_video(path, scenes, fps=10):
+    # Every scene is a solid gray level held for a number of frames
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), fps, (32, 32))
+    for level, frames in scenes:
+        for _ in range(frames):
+            writer.write(np.full((32, 32, 3), level, dtype=np.uint8))
+    writer.release()
+    return str(path)
+
+
+def test_sample_keyframes_picks_scene_changes(tmp_path):
+    video = write_video(tmp_path / "v.avi", [(0, 20), (200, 20), (0, 20)])
+    timestamps = [timestamp for timestamp, _ in process_videos.sample_keyframes(video, interval=1.0, check_every=0.5)]
+    # The still frames in between are duplicates of the picked ones
+    assert timestamps == [0.0, 2.0, 4.0]
+
+
+def test_sample_keyframes_seeks_over_long_gaps(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_videos, "SEEK_FRAMES", 2)
+    video = write_video(tmp_path / "v.avi", [(0, 20), (200, 20)])
+    timestamps = [timestamp for timestamp, _ in process_videos.sample_keyframes(video, check_every=0.5)]
+    assert timestamps == [0.0, 2.0]
+
+
+def test_sample_keyframes_of_a_missing_video(tmp_path):
+    assert list(process_videos.sample_keyframes(str(tmp_path / "missing.avi"))) == []
+
+
+def test_batched():
+    assert list(process_videos.batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(process_videos.batched([], 2)) == []
+
+
+class Budget:
+    def __init__(self):
+        self.shrunk = 0
+
+    def shrink(self):
+        self.shrunk += 1
+
+
+def test_process_video_skips_the_batches_that_fail(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "ofts.db")
+    ofts_db.initialize_database(db_path=db_path)
+    video = write_video(tmp_path / "v.avi", [(0, 10), (200, 10), (0, 10), (200, 10)])
+    calls = []
+
+    def tag_images_GIT(images):
+        calls.append(len(images))
+        if len(calls) == 1:
+            raise MemoryError()
+        if len(calls) == 2:
+            raise RuntimeError("model failure")
+        return ["A dog!"] * len(images)
+
+    monkeypatch.setattr(process_videos, "rec_face_array", lambda frame, *args: ["id1"])
+    monkeypatch.setattr(process_videos, "tag_images_GIT", tag_images_GIT)
+    budget = Budget()
+
+    assert process_videos.process_video(video, "Facenet", "cosine", 0.4, db_path=db_path, batch_size=1, budget=budget) == 2
+    assert budget.shrunk == 1
+    assert [row[1:] for row in ofts_db.search_video_frames("dog", db_path)] == [(2.0, "id1", "a dog"), (3.0, "id1", "a dog")]
+
+
+def test_process_video_shrinks_the_budget_on_a_failed_allocation(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "ofts.db")
+    ofts_db.initialize_database(db_path=db_path)
+    video = write_video(tmp_path / "v.avi", [(0, 10)])
+
+    def rec_face_array(frame, *args):
+        raise RuntimeError("DefaultCPUAllocator: can't allocate memory: you tried to allocate 1073741824 bytes")
+
+    monkeypatch.setattr(process_videos, "rec_face_array", rec_face_array)
+    budget = Budget()
+    assert process_videos.process_video(video, "Facenet", "cosine", 0.4, db_path=db_path, budget=budget) == 0
+    assert budget.shrunk == 1
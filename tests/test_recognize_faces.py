@@ -0,0 +1,121 @@
+import os
+import uuid
+
+import numpy as np
+import pytest
+
+pytest.importorskip("deepface")
+
+import recognize_faces
+
+
+@pytest.fixture
+def known_embeddings(tmp_path, monkeypatch):
+    for name in ("known_embedding_folder", "embedding_index_path", "shared_embedding_folders"):
+        monkeypatch.setattr(recognize_faces, name, getattr(recognize_faces, name))
+    monkeypatch.setattr(recognize_faces, "_INDEX_CACHE", {})
+    folder = str(tmp_path / "KNOWN_EMBEDDINGS")
+    recognize_faces.use_known_embedding_folder(folder)
+    return folder
+
+
+def add_files(folder, unique_id, names):
+    os.makedirs(os.path.join(folder, unique_id), exist_ok=True)
+    for name in names:
+        open(os.path.join(folder, unique_id, name), "w").close()
+
+
+def add_embeddings(folder, unique_id, embeddings):
+    os.makedirs(os.path.join(folder, unique_id), exist_ok=True)
+    for embedding in embeddings:
+        np.save(os.path.join(folder, unique_id, f"{uuid.uuid4().hex}.npy"), np.array(embedding, dtype=np.float32))
+
+
+def test_merge_identities(known_embeddings):
+    add_files(known_embeddings, "id1", ["a.npy", "a.jpg"])
+    add_files(known_embeddings, "id2", ["b.npy", "b.jpg"])
+    add_files(known_embeddings, "id3", ["c.npy"])
+
+    assert recognize_faces.merge_identities(["id1", "id2", "id3", "missing"]) == "id1"
+    assert sorted(os.listdir(known_embeddings)) == ["id1"]
+    assert sorted(os.listdir(os.path.join(known_embeddings, "id1"))) == ["a.jpg", "a.npy", "b.jpg", "b.npy", "c.npy"]
+
+
+def test_find_similar_identities(known_embeddings):
+    add_embeddings(known_embeddings, "id1", [[1, 0, 0], [0.9, 0.1, 0]])
+    add_embeddings(known_embeddings, "id2", [[0, 1, 0]])
+    add_embeddings(known_embeddings, "id3", [[0, 0, 1]])
+
+    similar = recognize_faces.find_similar_identities([[1, 0, 0], [0, 0.8, 0.2]], "cosine", top_k=2)
+    assert [unique_id for unique_id, _ in similar] == ["id1", "id2"]
+    assert similar[0][1] == pytest.approx(0, abs=1e-6)
+    assert recognize_faces.find_similar_identities([], "cosine") == []
+
+
+def test_similar_identities_of_another_library(known_embeddings, tmp_path):
+    other = str(tmp_path / "other" / "KNOWN_EMBEDDINGS")
+    add_embeddings(known_embeddings, "id1", [[1, 0]])
+    add_embeddings(other, "id9", [[0, 1], [0, 2]])
+
+    assert [unique_id for unique_id, _ in recognize_faces.find_similar_identities([[0, 1]], "euclidean", folder=other)] == ["id9"]
+    assert len(recognize_faces.identity_embeddings("id9", other)) == 2
+    assert len(recognize_faces.identity_embeddings("id9")) == 0
+    assert len(recognize_faces.identity_embeddings("id1")) == 1
+
+
+def test_embed_image_of_a_missing_or_broken_file(tmp_path):
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    assert recognize_faces.embed_image(str(tmp_path / "missing.jpg"), "Facenet") is None
+    assert recognize_faces.embed_image(str(broken), "Facenet") is None
+
+
+def reference_distance(embedding, given_embedding, distance_metric):
+    verification = pytest.importorskip("deepface.modules.verification")
+    if hasattr(verification, "find_distance"):
+        return verification.find_distance(embedding, given_embedding, distance_metric)
+    if distance_metric == "cosine":
+        return verification.find_cosine_distance(embedding, given_embedding)
+    if distance_metric == "euclidean_l2":
+        embedding, given_embedding = verification.l2_normalize(embedding), verification.l2_normalize(given_embedding)
+    return verification.find_euclidean_distance(embedding, given_embedding)
+
+
+@pytest.mark.parametrize("distance_metric", ["cosine", "euclidean", "euclidean_l2"])
+def test_find_distances_matches_deepface(distance_metric):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(5, 128)).astype(np.float32)
+    given_embedding = rng.normal(size=128).tolist()
+
+    distances = recognize_faces.find_distances(embeddings, given_embedding, distance_metric)
+    expected = [reference_distance(embedding, np.array(given_embedding), distance_metric) for embedding in embeddings]
+    assert distances == pytest.approx(expected, rel=1e-4)
+
+
+def test_embedding_index_follows_the_folder(known_embeddings):
+    add_embeddings(known_embeddings, "id1", [[1, 0]])
+    embeddings, identities = recognize_faces.load_embedding_index()
+    assert list(identities) == ["id1"]
+
+    # Only the new file is read, the cached rows are reused
+    add_embeddings(known_embeddings, "id2", [[0, 1]])
+    embeddings, identities = recognize_faces.load_embedding_index()
+    assert sorted(identities) == ["id1", "id2"]
+
+    recognize_faces.merge_identities(["id1", "id2"])
+    embeddings, identities = recognize_faces.load_embedding_index()
+    assert list(identities) == ["id1", "id1"]
+    assert len(embeddings) == 2
+
+
+def test_get_unique_id(known_embeddings):
+    add_embeddings(known_embeddings, "id1", [[1, 0]])
+
+    assert recognize_faces.get_unique_id([1, 0.01], "cosine", 0.4) == "id1"
+    new_id = recognize_faces.get_unique_id([0, 1], "cosine", 0.4)
+    assert new_id != "id1" and os.path.isdir(os.path.join(known_embeddings, new_id))
+
+    # The match was merged into another identity meanwhile, so it is matched again
+    add_embeddings(known_embeddings, "id2", [[1, 0.02]])
+    recognize_faces.merge_identities(["id2", "id1"])
+    assert recognize_faces.get_unique_id([1, 0.01], "cosine", 0.4, match="id1") == "id2"